@@ -0,0 +1,184 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import functools
+import subprocess
+import psycopg2
+from generate_data import generate
+from etl import process_data, process_data_parallel, process_song_file, process_log_file
+from etl import read_log_file, load_log_file, load_song_index, process_song_batches
+
+dsn = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def reset_log_tables(cur, conn):
+    """
+    Description: This function can be used to empty the tables filled from the log data
+    so every benchmark run starts from the same state.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection string
+
+    Returns:
+        None
+    """
+
+    cur.execute("TRUNCATE songplays, users, time")
+    conn.commit()
+
+
+def time_run(cur, load, table='songplays'):
+    """
+    Description: This function can be used to time one load
+    and count the records of the table it fills.
+
+    Arguments:
+        cur: the cursor object.
+        load: function without arguments running the load
+        table: table counted after the load
+
+    Returns:
+        (seconds, rows)
+    """
+
+    # keep the per-file progress lines out of the report
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        load()
+    elapsed = time.perf_counter() - start
+
+    cur.execute("SELECT COUNT(*) FROM {}".format(table))
+    return elapsed, cur.fetchone()[0]
+
+
+def report(name, elapsed, rows):
+    print('{:<24} {:>8} rows {:>8.2f} s {:>10.0f} rows/s'.format(name, rows, elapsed, rows / elapsed))
+
+
+def run_etl(data, etl_args):
+    """
+    Description: This function can be used to run etl.py on a data directory in a child process
+    and measure its wall time and peak memory.
+
+    Arguments:
+        data: directory holding the song_data and log_data folders.
+        etl_args: extra etl.py arguments, e.g. ['--bulk'].
+
+    Returns:
+        (seconds, peak RSS in MB)
+    """
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'etl.py', '--data', data] + etl_args, stdout=subprocess.DEVNULL)
+    # wait4 returns the resource usage of this child only, not of every child waited for so far
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status:
+        raise RuntimeError('etl.py failed on {}'.format(data))
+
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def benchmark_scales(scales, etl_args, results=None):
+    """
+    Description: This function can be used to load generated data at every scale into empty tables
+    and report the rows loaded per second and the peak memory of etl.py.
+
+    Arguments:
+        scales: sizes relative to the bundled sample, e.g. [10, 100, 1000].
+        etl_args: extra etl.py arguments, e.g. ['--bulk'].
+        results: file the results are written to as JSON.
+
+    Returns:
+        None
+    """
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    rows = []
+    print('{:>6} {:>9} {:>10} {:>10} {:>9} {:>10} {:>9}'.format(
+        'scale', 'songs', 'events', 'songplays', 'seconds', 'rows/s', 'peak MB'))
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as data:
+            num_songs, num_events = generate(data, scale)
+
+            cur.execute("TRUNCATE songplays, users, time, songs, artists, file_manifest")
+            conn.commit()
+            elapsed, peak_rss = run_etl(data, etl_args)
+
+        cur.execute("SELECT COUNT(*) FROM songplays")
+        num_songplays = cur.fetchone()[0]
+
+        # rows/s counts every song and event read, the songplays are the NextSong events among them
+        row = {'scale': scale, 'songs': num_songs, 'events': num_events, 'songplays': num_songplays,
+               'seconds': elapsed, 'rows_per_second': (num_songs + num_events) / elapsed, 'peak_rss_mb': peak_rss}
+        rows.append(row)
+        print('{scale:>6} {songs:>9} {events:>10} {songplays:>10} {seconds:>9.2f} '
+              '{rows_per_second:>10.0f} {peak_rss_mb:>9.1f}'.format(**row))
+
+    if results:
+        with open(results, 'w') as f:
+            json.dump({'etl_args': etl_args, 'runs': rows}, f, indent=2)
+
+    cur.close()
+    conn.close()
+
+
+def benchmark_modes():
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    # song load: one transaction per file against batches of files read by a thread pool,
+    # the last run leaves the songs and artists the songplays resolve against
+    for name, load in [('song_data per file', lambda: process_data(cur, conn, 'data/song_data', process_song_file)),
+                       ('song_data batches', lambda: process_song_batches(cur, conn, 'data/song_data'))]:
+        cur.execute("TRUNCATE songplays, songs, artists")
+        conn.commit()
+        report(name, *time_run(cur, load, 'songs'))
+
+    # songplay load: one INSERT per row against one COPY per file,
+    # songs resolved by one query per event against the in-memory song index
+    song_index = load_song_index(cur)
+    for name, func in [('log_data row-at-a-time', process_log_file),
+                       ('log_data COPY', functools.partial(process_log_file, bulk=True)),
+                       ('log_data song index', functools.partial(process_log_file, song_index=song_index)),
+                       ('log_data COPY + index', functools.partial(process_log_file, bulk=True, song_index=song_index))]:
+        reset_log_tables(cur, conn)
+        report(name, *time_run(cur, lambda: process_data(cur, conn, 'data/log_data', func)))
+
+    # the COPY + index load spread over parsing processes and writer connections
+    load = functools.partial(load_log_file, bulk=True, song_index=song_index)
+    for workers in [2, 4]:
+        reset_log_tables(cur, conn)
+        report('log_data {} workers'.format(workers),
+               *time_run(cur, lambda: process_data_parallel(dsn, 'data/log_data', read_log_file, load, workers)))
+
+    cur.close()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Sparkify loaders')
+    parser.add_argument('--scales', type=float, nargs='+',
+                        help='run etl.py on generated data at these sizes relative to the sample, e.g. 10 100 1000')
+    parser.add_argument('--etl-args', default='--bulk',
+                        help='arguments passed to etl.py by the --scales runs')
+    parser.add_argument('--results', metavar='FILE', help='write the --scales results to FILE as JSON')
+    args = parser.parse_args()
+
+    if args.scales:
+        benchmark_scales(args.scales, args.etl_args.split(), args.results)
+    else:
+        benchmark_modes()
+
+
+if __name__ == "__main__":
+    main()
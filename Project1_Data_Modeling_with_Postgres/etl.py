@@ -1,125 +1,601 @@
 import os
+import io
+import sys
+import json
 import glob
+import hashlib
+import argparse
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import psycopg2
 import pandas as pd
+from psycopg2.extras import execute_values
 from sql_queries import *
+from instrumentation import CountingCursor, PipelineStats
 
 
-def process_song_file(cur, filepath):
-"""
-Description: This function can be used to read the file in the filepath (data/song_data)
-to get the song and its information to populate in the songs and artirst tables
+class DimensionKeys:
+    """
+    Description: Keys of the songs, artists and users rows already written during the run.
+    Rows whose key is known are not sent again, and the ON CONFLICT clauses of the bulk inserts
+    take care of rows loaded by earlier runs, so no SELECT COUNT(*) pre-check is needed.
+    The rows of a versioned table end with their version (the level_ts of users): a known key
+    is sent again with a newer version, the insert keeps the newest version.
+    Keys are kept per thread: a writer connection only skips rows it has written itself,
+    never rows another connection has not committed yet.
+    """
 
-Arguments:
-    cur: the cursor object. 
-    filepath: song_data file path. 
+    tables = ('songs', 'artists', 'users')
+    versioned = ('users',)
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.statements_saved = 0
+
+    def new_rows(self, table, rows):
+        """
+        Description: This function can be used to drop the rows whose key (first column)
+        was already written, keeping the first row of every new key, or for a versioned table
+        the row of the newest version when it is newer than the one written.
+
+        Arguments:
+            table: songs, artists or users.
+            rows: records in the column order of the table insert.
+
+        Returns:
+            list of records to insert
+        """
+
+        if not hasattr(self.local, 'keys'):
+            self.local.keys = {name: {} for name in self.tables}
+        keys = self.local.keys[table]
+        versioned = table in self.versioned
+
+        # key -> row, one row per key as an INSERT ... ON CONFLICT cannot update a row twice
+        new = {}
+        for row in rows:
+            if row[0] not in keys or (versioned and row[-1] > keys[row[0]]):
+                keys[row[0]] = row[-1] if versioned else None
+                new[row[0]] = row
+        new = list(new.values())
+
+        # pre-check path: one SELECT COUNT(*) per row and one INSERT per new row,
+        # bulk path: one INSERT for all new rows
+        with self.lock:
+            self.statements_saved += len(rows) + len(new) - (1 if new else 0)
+
+        return new
+
+
+def insert_new_rows(cur, query, table, rows, dimension_keys):
+    """
+    Description: This function can be used to insert the rows of a dimension table
+    not written yet during the run with one multi-row INSERT ... ON CONFLICT
+
+    Arguments:
+        cur: the cursor object.
+        query: bulk insert query of the table.
+        table: songs, artists or users.
+        rows: records in the column order of the table insert.
+        dimension_keys: DimensionKeys of the run.
+
+    Returns:
+        None
+    """
+
+    rows = dimension_keys.new_rows(table, rows)
+    if rows:
+        execute_values(cur, query, rows, page_size=len(rows))
+
+
+def load_song_index(cur):
+    """
+    Description: This function can be used to build the in-memory song index once per run
+    from the songs and artists tables, so songplays resolve their song_id and artist_id
+    with a dict lookup instead of a song_select_by_song_id_artist_id round trip per event.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        dict of (title, artist name, duration) -> (song_id, artist_id)
+    """
+
+    cur.execute(song_index_select)
+    return {(title, name, duration): (song_id, artist_id)
+            for title, name, duration, song_id, artist_id in cur.fetchall()}
+
+
+def read_song_file(filepath):
+    """
+    Description: This function can be used to parse the file in the filepath (data/song_data)
+    without touching the database, so it can run in a worker process.
+
+    Arguments:
+        filepath: song_data file path.
+
+    Returns:
+        song record as a pandas Series
+    """
 
-Returns:
-    None
-"""
-    
     # open song file
-    df = pd.read_json(filepath, typ='series')
+    return pd.read_json(filepath, typ='series')
+
+
+def load_song_record(cur, df, song_index=None, dimension_keys=None):
+    """
+    Description: This function can be used to populate the songs and artirst tables
+    with a song record parsed by read_song_file
+
+    Arguments:
+        cur: the cursor object.
+        df: song record from read_song_file.
+        song_index: song index from load_song_index, updated with the song of the record.
+        dimension_keys: DimensionKeys of the run, songs and artists already written are skipped.
+
+    Returns:
+        None
+    """
+
+    if dimension_keys is None:
+        dimension_keys = DimensionKeys()
 
     # insert song record
     song_data = df[['song_id','title','artist_id', 'year', 'duration']]
-  
-    # check for song_id duplicates
-    cur.execute(song_select, (song_data[['song_id']]))
-    results = cur.fetchone()
-    
-    # if no duplicates then insert new records
-    if results[0] == 0:
-        cur.execute(song_table_insert, song_data)
-        
+    insert_new_rows(cur, song_table_bulk_insert, 'songs', [tuple(song_data)], dimension_keys)
+
     # insert artist record
     artist_data = df[['artist_id','artist_name','artist_location', 'artist_latitude', 'artist_longitude']]
-    
-    # check for artist_id duplicates
-    cur.execute(artist_select, (artist_data[['artist_id']]))
-    results = cur.fetchone()
-   
-    if results[0] == 0:
-        cur.execute(artist_table_insert, artist_data)
+    insert_new_rows(cur, artist_table_bulk_insert, 'artists', [tuple(artist_data)], dimension_keys)
+
+    # keep the song index in step with the songs table, the first loaded record wins
+    if song_index is not None:
+        song_index.setdefault((df['title'], df['artist_name'], df['duration']), (df['song_id'], df['artist_id']))
+
+
+def process_song_file(cur, filepath, song_index=None, dimension_keys=None):
+    """
+    Description: This function can be used to read the file in the filepath (data/song_data)
+    to get the song and its information to populate in the songs and artirst tables
+
+    Arguments:
+        cur: the cursor object.
+        filepath: song_data file path.
+        song_index: song index from load_song_index, updated with the song of the file.
+        dimension_keys: DimensionKeys of the run, songs and artists already written are skipped.
+
+    Returns:
+        None
+    """
+
+    load_song_record(cur, read_song_file(filepath), song_index, dimension_keys)
+
+
+def read_song_files(filepaths, workers=8):
+    """
+    Description: This function can be used to parse many song files (data/song_data) at once.
+    The files are read by a pool of threads and their records parsed together into one DataFrame,
+    with the same JSON parser as read_song_file so durations match the log lengths exactly.
+
+    Arguments:
+        filepaths: song_data file paths.
+        workers: number of threads reading files.
+
+    Returns:
+        song records as a pandas DataFrame, one row per file, missing values as None
+    """
+
+    def read(filepath):
+        with open(filepath, encoding='utf8') as f:
+            return f.read()
+
+    with ThreadPoolExecutor(workers) as pool:
+        records = '[' + ','.join(pool.map(read, filepaths)) + ']'
+
+    df = pd.read_json(io.StringIO(records), orient='records')
+
+    # psycopg2 would write missing floats as NaN instead of NULL
+    return df.astype(object).where(df.notna(), None)
+
+
+def load_song_batch(cur, df, song_index=None, dimension_keys=None):
+    """
+    Description: This function can be used to populate the songs and artirst tables
+    with the song records parsed by read_song_files, one statement per table
+
+    Arguments:
+        cur: the cursor object.
+        df: song records from read_song_files.
+        song_index: song index from load_song_index, updated with the songs of the records.
+        dimension_keys: DimensionKeys of the run, songs and artists already written are skipped.
+
+    Returns:
+        None
+    """
+
+    if dimension_keys is None:
+        dimension_keys = DimensionKeys()
+
+    # insert song records, the first record of every song wins
+    song_data = df[['song_id','title','artist_id', 'year', 'duration']].drop_duplicates('song_id')
+    insert_new_rows(cur, song_table_bulk_insert, 'songs',
+                    list(song_data.itertuples(index=False, name=None)), dimension_keys)
+
+    # insert artist records, the first record of every artist wins
+    artist_data = df[['artist_id','artist_name','artist_location', 'artist_latitude', 'artist_longitude']]
+    insert_new_rows(cur, artist_table_bulk_insert, 'artists',
+                    list(artist_data.drop_duplicates('artist_id').itertuples(index=False, name=None)), dimension_keys)
+
+    # keep the song index in step with the songs table, the first loaded record wins
+    if song_index is not None:
+        index_data = df[['title', 'artist_name', 'duration', 'song_id', 'artist_id']]
+        for title, artist_name, duration, song_id, artist_id in index_data.itertuples(index=False, name=None):
+            song_index.setdefault((title, artist_name, duration), (song_id, artist_id))
+
+
+def process_song_batches(cur, conn, filepath, song_index=None, dimension_keys=None, batch_size=1000,
+                         workers=8, checkpoint=False, stats=None):
+    """
+    Description: This function can be used to load all song files of filepath in batches.
+    Every batch of files is read at once by read_song_files and loaded and committed
+    in one transaction by load_song_batch.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection string
+        filepath: file path of all song files
+        song_index: song index from load_song_index, updated with the songs of the files.
+        dimension_keys: DimensionKeys of the run, songs and artists already written are skipped.
+        batch_size: number of files per transaction.
+        workers: number of threads reading files.
+        checkpoint: only process the files file_manifest does not record as loaded, and record every file processed
+        stats: PipelineStats of the run, the stages of every batch are recorded under its first file
+
+    Returns:
+        None
+    """
+
+    if stats is None:
+        stats = PipelineStats()
+
+    all_files = get_files(filepath)
+    if checkpoint:
+        all_files = pending_files(cur, all_files)
+        conn.commit()
+
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    for start in range(0, num_files, batch_size):
+        batch = all_files[start:start + batch_size]
+        stats.set_file(batch[0])
+        try:
+            with stats.stage('parse') as parse:
+                df = read_song_files(batch, workers)
+                parse['rows'] = len(df)
+                parse['bytes'] = sum(os.path.getsize(datafile) for datafile in batch)
+
+            with stats.stage('song load', cur) as load:
+                load_song_batch(cur, df, song_index, dimension_keys)
+                load['rows'] = len(df)
+
+            with stats.stage('commit', cur) as commit:
+                if checkpoint:
+                    record_files(cur, batch, 'loaded')
+                conn.commit()
+                commit['round_trips'] = 1
+        except Exception:
+            conn.rollback()
+            if checkpoint:
+                record_files(cur, batch, 'failed')
+                conn.commit()
+            raise
+        print('{}/{} files processed.'.format(start + len(batch), num_files))
+        stats.print_progress()
+
+
+def copy_songplays(cur, songplay_data):
+    """
+    Description: This function can be used to load many songplay records at once.
+    The records are staged into an in-memory CSV buffer and pushed with a single
+    COPY ... FROM STDIN instead of one INSERT per record.
+
+    Arguments:
+        cur: the cursor object.
+        songplay_data: list of songplay tuples in songplay_table_insert column order.
+
+    Returns:
+        None
+    """
+
+    if not songplay_data:
+        return
 
+    # stage the records as CSV, NULLs are written as \N so empty strings stay empty strings
+    buffer = io.StringIO()
+    pd.DataFrame(songplay_data).to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
 
-def process_log_file(cur, filepath):
-"""
-Description: This function can be used to read the file in the filepath (data/log_data)
-to get the user and time info and used to populate the users and time dim tables.
+    cur.copy_expert(songplay_table_copy, buffer)
 
-Arguments:
-    cur: the cursor object. 
-    filepath: log data file path. 
 
-Returns:
-    None
-"""
+def read_log_file(filepath):
+    """
+    Description: This function can be used to parse the file in the filepath (data/log_data)
+    and keep the NextSong events, without touching the database, so it can run in a worker process.
+
+    Arguments:
+        filepath: log data file path.
+
+    Returns:
+        NextSong events as a pandas DataFrame
+    """
 
     # open log file
     df = pd.read_json(filepath, lines=True)
 
     # filter by NextSong action
-    df = df[df['page'] == 'NextSong']
+    return df[df['page'] == 'NextSong']
+
+
+def read_log_chunks(filepath, chunksize=10000, stats=None):
+    """
+    Description: This function can be used to stream the NextSong events of the file in the filepath
+    (data/log_data) in chunks of at most chunksize events, so memory does not grow with the file size.
+    Lines without NextSong are dropped as raw text, before any column is parsed.
+
+    Arguments:
+        filepath: log data file path.
+        chunksize: number of NextSong events per chunk.
+        stats: PipelineStats of the run, records the parse and filter stages.
+
+    Returns:
+        generator of NextSong events as pandas DataFrames
+    """
+
+    if stats is None:
+        stats = PipelineStats()
+
+    with open(filepath, 'rb') as f:
+        while True:
+            with stats.stage('parse') as parse:
+                chunk = []
+                for line in f:
+                    parse['bytes'] += len(line)
+                    if b'NextSong' in line:
+                        chunk.append(line)
+                        if len(chunk) == chunksize:
+                            break
+                if not chunk:
+                    break
+
+                df = pd.read_json(io.StringIO(b''.join(chunk).decode('utf8')), lines=True)
+                parse['rows'] = len(df)
+
+            # the raw text check lets through lines with NextSong outside the page field
+            with stats.stage('filter') as filter_:
+                df = df[df['page'] == 'NextSong']
+                filter_['rows'] = len(df)
+
+            yield df
+
+
+def build_time_table(ts):
+    """
+    Description: This function can be used to build the time dimension records of
+    the given timestamps, one record per distinct timestamp, with vectorized pandas accessors
+
+    Arguments:
+        ts: event timestamps in milliseconds.
+
+    Returns:
+        time records as a pandas DataFrame sorted by start_time
+    """
+
+    t = pd.to_datetime(pd.Series(ts).drop_duplicates(), unit='ms').sort_values()
+
+    return pd.DataFrame({'start_time': t,
+                         'hour': t.dt.hour,
+                         'day': t.dt.day,
+                         'week': t.dt.isocalendar().week.astype('int64'),
+                         'month': t.dt.month,
+                         'year': t.dt.year,
+                         'weekday': t.dt.weekday})
+
+
+def insert_time_rows(cur, time_df):
+    """
+    Description: This function can be used to insert the time records of build_time_table
+    with one multi-row INSERT ... ON CONFLICT
+
+    Arguments:
+        cur: the cursor object.
+        time_df: time records from build_time_table.
+
+    Returns:
+        None
+    """
+
+    time_data = list(time_df.itertuples(index=False, name=None))
+    if time_data:
+        execute_values(cur, time_table_bulk_insert, time_data, page_size=len(time_data))
+
+
+def load_time_table(cur, filepaths, stats=None):
+    """
+    Description: This function can be used to load the time dimension of a whole run at once.
+    The timestamps of the NextSong events of every log file are collected and deduplicated,
+    then the time records are built and inserted with a single statement.
+
+    Arguments:
+        cur: the cursor object.
+        filepaths: log data file paths.
+        stats: PipelineStats of the run, the stages are recorded under 'time stage'.
+
+    Returns:
+        number of time records inserted
+    """
+
+    if stats is None:
+        stats = PipelineStats()
+    stats.set_file('time stage')
+
+    # only the distinct timestamps of every chunk are kept
+    ts = [chunk['ts'].drop_duplicates() for filepath in filepaths for chunk in read_log_chunks(filepath, stats=stats)]
+    if not ts:
+        return 0
+
+    with stats.stage('time build', cur) as build:
+        time_df = build_time_table(pd.concat(ts))
+        insert_time_rows(cur, time_df)
+        build['rows'] = len(time_df)
+
+    return len(time_df)
+
+
+def load_log_records(cur, df, bulk=False, song_index=None, dimension_keys=None, load_time=True, stats=None,
+                     source_file=None):
+    """
+    Description: This function can be used to populate the time, users and songplays tables
+    with the NextSong events parsed by read_log_file
+
+    Arguments:
+        cur: the cursor object.
+        df: NextSong events from read_log_file.
+        bulk: load the songplay records with one COPY instead of one INSERT per record.
+        song_index: song index from load_song_index, queried instead of the songs and artists tables.
+        dimension_keys: DimensionKeys of the run, users already written are skipped.
+        load_time: insert the time records of the events, off when load_time_table already ran.
+        stats: PipelineStats of the run, records the time build, user load, songplay lookup
+            and songplay insert stages.
+        source_file: log file of the events, recorded on their songplays.
+
+    Returns:
+        None
+    """
+
+    if dimension_keys is None:
+        dimension_keys = DimensionKeys()
+    if stats is None:
+        stats = PipelineStats()
 
     # convert timestamp column to datetime
     t=pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records to dataframe 
-    time_data = [t, t.dt.hour, t.dt.day, t.dt.weekofyear, t.dt.month, t.dt.year,t.dt.weekday]
-    column_labels = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
 
-    dictionary = dict(zip(column_labels, time_data))
-    time_df = pd.DataFrame.from_dict(dictionary)
+    # insert time records, sorted by start_time so concurrent writers lock them in the same order
+    if load_time:
+        with stats.stage('time build', cur) as build:
+            time_df = build_time_table(df['ts'])
+            insert_time_rows(cur, time_df)
+            build['rows'] = len(time_df)
 
-    
-    for i, row in time_df.iterrows():
-    cur.execute(time_table_insert, list(row))
-        
 
     # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
-
-    # insert user records
-    for i, row in user_df.iterrows():
-        # check for user_id duplicates
-        cur.execute(user_select, (str(row.userId),))
-        results = cur.fetchone()
-        
-        if results[0] == 0:
-            cur.execute(user_table_insert, row)
-
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select_by_song_id_artist_id, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
+    with stats.stage('user load', cur) as load:
+        # userId is parsed as a number or a string depending on the file, compare and sort it as a string
+        user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level', 'ts']].astype({'userId': str})
+
+        # insert user records, the level of the latest event of every user wins
+        user_data = list(user_df.sort_values(['userId', 'ts'], kind='stable').itertuples(index=False, name=None))
+        insert_new_rows(cur, user_table_bulk_insert, 'users', user_data, dimension_keys)
+        load['rows'] = len(user_data)
+
+    # build songplay records
+    with stats.stage('songplay lookup', cur) as lookup:
+        songplays = []
+        for index, row in df.assign(start_time=t).iterrows():
+
+            # get songid and artistid from the song index, or from song and artist tables
+            if song_index is not None:
+                results = song_index.get((row.song, row.artist, row.length))
+            else:
+                cur.execute(song_select_by_song_id_artist_id, (row.song, row.artist, row.length))
+                results = cur.fetchone()
+
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
+
+            songplays.append((row.start_time, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent,
+                              source_file))
+        lookup['rows'] = len(songplays)
+
+    # insert songplay records, all records of the chunk with one COPY or one INSERT per record
+    with stats.stage('songplay insert', cur) as insert:
+        if bulk:
+            copy_songplays(cur, songplays)
         else:
-            songid, artistid = None, None
-
-        # insert songplay record
-        songplay_data = (row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
-      
-    
-def process_data(cur, conn, filepath, func):
-"""
-Description: This function can be used to read all files machting extension from directory, get the number of files found
-iterate over files and process
-
-Arguments:
-    cur: the cursor object.
-    conn: connection string
-    filepath: file path of all files
-    func: iterate the files, process and commit
-
-Returns:
-    None
-"""
+            for songplay_data in songplays:
+                cur.execute(songplay_table_insert, songplay_data)
+        insert['rows'] = len(songplays)
+
+
+def process_log_file(cur, filepath, bulk=False, song_index=None, dimension_keys=None, load_time=True,
+                     chunksize=10000, stats=None):
+    """
+    Description: This function can be used to read the file in the filepath (data/log_data)
+    to get the user and time info and used to populate the users and time dim tables.
+
+    Arguments:
+        cur: the cursor object.
+        filepath: log data file path.
+        bulk: load the songplay records of the file with one COPY instead of one INSERT per record.
+        song_index: song index from load_song_index, queried instead of the songs and artists tables.
+        dimension_keys: DimensionKeys of the run, users already written are skipped.
+        load_time: insert the time records of the file, off when load_time_table already ran.
+        chunksize: number of NextSong events read and loaded at a time.
+        stats: PipelineStats of the run, records every stage of the file.
+
+    Returns:
+        None
+    """
+
+    # users seen in a chunk are not sent again for the next chunks of the file
+    if dimension_keys is None:
+        dimension_keys = DimensionKeys()
+
+    # a changed file is loaded again, its earlier songplays are replaced in the same transaction
+    cur.execute(songplay_file_delete, (filepath,))
+    for df in read_log_chunks(filepath, chunksize, stats):
+        load_log_records(cur, df, bulk, song_index, dimension_keys, load_time, stats, filepath)
+
+
+def load_log_file(cur, filepath, df, bulk=False, song_index=None, dimension_keys=None, load_time=True, stats=None):
+    """
+    Description: This function can be used to load the NextSong events of a log file parsed by read_log_file,
+    replacing the songplays of an earlier load of the file, see process_log_file
+
+    Arguments:
+        cur: the cursor object.
+        filepath: log data file path.
+        df: NextSong events of the file from read_log_file.
+        bulk: load the songplay records with one COPY instead of one INSERT per record.
+        song_index: song index from load_song_index, queried instead of the songs and artists tables.
+        dimension_keys: DimensionKeys of the run, users already written are skipped.
+        load_time: insert the time records of the events, off when load_time_table already ran.
+        stats: PipelineStats of the run, records the stages of load_log_records.
+
+    Returns:
+        None
+    """
+
+    cur.execute(songplay_file_delete, (filepath,))
+    load_log_records(cur, df, bulk, song_index, dimension_keys, load_time, stats, filepath)
+
+
+def get_files(filepath):
+    """
+    Description: This function can be used to list all JSON files under filepath
+
+    Arguments:
+        filepath: file path of all files
+
+    Returns:
+        list of absolute file paths
+    """
 
     # get all files matching extension from directory
     all_files = []
@@ -128,27 +604,314 @@ Returns:
         for f in files :
             all_files.append(os.path.abspath(f))
 
+    return all_files
+
+
+def file_fingerprint(filepath):
+    """
+    Description: This function can be used to identify the content of a data file
+
+    Arguments:
+        filepath: data file path.
+
+    Returns:
+        (size, mtime, md5 hex digest)
+    """
+
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime, md5.hexdigest()
+
+
+def record_file(cur, filepath, status):
+    """
+    Description: This function can be used to record the load outcome of a data file in file_manifest.
+    Called before the commit of the file, the record is committed together with the data of the file.
+
+    Arguments:
+        cur: the cursor object.
+        filepath: data file path.
+        status: loaded or failed.
+
+    Returns:
+        None
+    """
+
+    cur.execute(file_manifest_insert, (filepath,) + file_fingerprint(filepath) + (status,))
+
+
+def record_files(cur, filepaths, status):
+    """
+    Description: This function can be used to record the load outcome of many data files
+    in file_manifest with one statement, see record_file.
+
+    Arguments:
+        cur: the cursor object.
+        filepaths: data file paths.
+        status: loaded or failed.
+
+    Returns:
+        None
+    """
+
+    records = [(filepath,) + file_fingerprint(filepath) + (status,) for filepath in filepaths]
+    if records:
+        execute_values(cur, file_manifest_bulk_insert, records, page_size=len(records))
+
+
+def pending_files(cur, all_files):
+    """
+    Description: This function can be used to keep the data files that still need to be loaded:
+    files never loaded, files whose last load failed and files whose content changed since.
+    Files with the size and mtime recorded in file_manifest are skipped without reading them,
+    files only touched since (same content hash) are skipped and get their new mtime recorded.
+
+    Arguments:
+        cur: the cursor object.
+        all_files: data file paths.
+
+    Returns:
+        list of data file paths to load
+    """
+
+    cur.execute(file_manifest_select)
+    manifest = {filepath: (size, mtime, md5) for filepath, size, mtime, md5 in cur.fetchall()}
+
+    pending = []
+    for filepath in all_files:
+        loaded = manifest.get(filepath)
+        if loaded is not None:
+            stat = os.stat(filepath)
+            if (stat.st_size, stat.st_mtime) == loaded[:2]:
+                continue
+            if file_fingerprint(filepath)[::2] == loaded[::2]:
+                record_file(cur, filepath, 'loaded')
+                continue
+        pending.append(filepath)
+
+    return pending
+
+
+def process_data(cur, conn, filepath, func, checkpoint=False, stats=None):
+    """
+    Description: This function can be used to read all files machting extension from directory, get the number of files found
+    iterate over files and process
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection string
+        filepath: file path of all files
+        func: iterate the files, process and commit
+        checkpoint: only process the files file_manifest does not record as loaded, and record every file processed
+        stats: PipelineStats of the run, the stages of func are recorded under the file being processed
+
+    Returns:
+        None
+    """
+
+    if stats is None:
+        stats = PipelineStats()
+
+    # get all files matching extension from directory
+    all_files = get_files(filepath)
+    if checkpoint:
+        all_files = pending_files(cur, all_files)
+        conn.commit()
+
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
     # iterate over files and process
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
+        stats.set_file(datafile)
+        try:
+            func(cur, datafile)
+            with stats.stage('commit', cur) as commit:
+                if checkpoint:
+                    record_file(cur, datafile, 'loaded')
+                conn.commit()
+                commit['round_trips'] = 1
+        except Exception:
+            conn.rollback()
+            if checkpoint:
+                record_file(cur, datafile, 'failed')
+                conn.commit()
+            raise
         print('{}/{} files processed.'.format(i, num_files))
+        stats.print_progress()
+
+
+def process_data_parallel(dsn, filepath, read_func, load_func, workers, checkpoint=False, stats=None):
+    """
+    Description: This function can be used to process all files of filepath in parallel.
+    A pool of worker processes parses the files with read_func while a pool of writer threads,
+    each with its own connection, loads every parsed file with load_func and commits it.
+    At most 2 * workers files are being parsed or loaded at a time, a new file is only read once
+    a file is committed, so memory is bounded by the largest files and not by the whole dataset.
+    All files are committed when the function returns.
+
+    Arguments:
+        dsn: connection string
+        filepath: file path of all files
+        read_func: parse one file, runs in a worker process
+        load_func: load one parsed file with a cursor, the file path and the result of read_func, runs in a writer thread
+        workers: number of worker processes and of writer connections
+        checkpoint: only process the files file_manifest does not record as loaded, and record every file processed
+        stats: PipelineStats of the run, the stages of load_func and the commits are recorded
+            under the file being processed, parsing in the worker processes is not recorded
+
+    Returns:
+        None
+    """
+
+    if stats is None:
+        stats = PipelineStats()
+
+    all_files = get_files(filepath)
+    if checkpoint:
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+            all_files = pending_files(cur, all_files)
+        conn.close()
+
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    # one connection per writer thread, opened on first use
+    local = threading.local()
+    connections = []
+
+    def write(datafile, df):
+        if not hasattr(local, 'conn'):
+            local.conn = psycopg2.connect(dsn)
+            connections.append(local.conn)
+        stats.set_file(datafile)
+        with local.conn.cursor(cursor_factory=CountingCursor) as cur:
+            try:
+                load_func(cur, datafile, df)
+                with stats.stage('commit', cur) as commit:
+                    if checkpoint:
+                        record_file(cur, datafile, 'loaded')
+                    local.conn.commit()
+                    commit['round_trips'] = 1
+            except Exception:
+                local.conn.rollback()
+                if checkpoint:
+                    record_file(cur, datafile, 'failed')
+                    local.conn.commit()
+                raise
+
+    try:
+        with ProcessPoolExecutor(workers) as readers, ThreadPoolExecutor(workers) as writers:
+            files = iter(all_files)
+            # future -> (stage, file) of the files being read or written, a parsed file is only
+            # referenced by its future until it is committed
+            in_flight = {}
+
+            def read_next():
+                datafile = next(files, None)
+                if datafile is not None:
+                    in_flight[readers.submit(read_func, datafile)] = ('read', datafile)
+
+            for _ in range(2 * workers):
+                read_next()
+
+            i = 0
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, datafile = in_flight.pop(future)
+                    if stage == 'read':
+                        in_flight[writers.submit(write, datafile, future.result())] = ('write', datafile)
+                    else:
+                        future.result()
+                        i += 1
+                        print('{}/{} files processed.'.format(i, num_files))
+                        stats.print_progress()
+                        read_next()
+    finally:
+        for conn in connections:
+            conn.close()
+
 
-        
 def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
+    parser = argparse.ArgumentParser(description='Load the song and log data into sparkifydb')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load songplays with one COPY per log file instead of one INSERT per row')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing log files and of connections loading them')
+    parser.add_argument('--song-batch', type=int, default=1000,
+                        help='number of song files read and loaded in one transaction')
+    parser.add_argument('--chunksize', type=int, default=10000,
+                        help='number of log events read and loaded at a time by a serial run')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write the timings of every stage of every file to FILE as JSON')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a live progress line with the rows loaded per second on stderr')
+    parser.add_argument('--data', default='data',
+                        help='directory holding the song_data and log_data folders')
+    args = parser.parse_args()
+
+    dsn = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor(cursor_factory=CountingCursor)
+    stats = PipelineStats(progress=args.progress)
+
+    # databases created before file_manifest, songplays.source_file and users.level_ts existed get them here
+    cur.execute(file_manifest_create)
+    cur.execute(songplay_source_file_add)
+    cur.execute(songplay_source_file_index)
+    cur.execute(user_level_ts_add)
+    conn.commit()
+
+    # load the song index once, the song files keep it up to date
+    song_index = load_song_index(cur)
+    dimension_keys = DimensionKeys()
+
+    # song files are fully committed before the first log file is loaded,
+    # so songplays always resolve against every song and artist
+    song_data = os.path.join(args.data, 'song_data')
+    log_data = os.path.join(args.data, 'log_data')
+    process_song_batches(cur, conn, song_data, song_index, dimension_keys,
+                         batch_size=args.song_batch, checkpoint=True, stats=stats)
+
+    # the time records of every log file to load are loaded in one statement before any songplay references them
+    num_times = load_time_table(cur, pending_files(cur, get_files(log_data)), stats)
+    with stats.stage('commit', cur) as commit:
+        conn.commit()
+        commit['round_trips'] = 1
+    print('{} time records loaded.'.format(num_times))
+
+    if args.workers > 1:
+        process_data_parallel(dsn, log_data, read_log_file,
+                              functools.partial(load_log_file, bulk=args.bulk, song_index=song_index,
+                                                dimension_keys=dimension_keys, load_time=False, stats=stats),
+                              args.workers, checkpoint=True, stats=stats)
+    else:
+        process_data(cur, conn, filepath=log_data,
+                     func=functools.partial(process_log_file, bulk=args.bulk, song_index=song_index,
+                                            dimension_keys=dimension_keys, load_time=False,
+                                            chunksize=args.chunksize, stats=stats),
+                     checkpoint=True, stats=stats)
+
+    if args.progress:
+        sys.stderr.write('\n')
+    print('{} statements saved on songs, artists and users.'.format(dimension_keys.statements_saved))
+
+    # totals per stage on stdout, every file in the report file
+    report = stats.report()
+    print(json.dumps({'seconds': report['seconds'], 'stages': report['stages']}, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
- 
     cur.close()
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,258 @@
+import os
+import csv
+import json
+import random
+import string
+import argparse
+from datetime import datetime, timedelta
+
+# the bundled sample: 71 song files and about 8000 log events over the 30 days of November 2018
+SAMPLE_SONGS = 71
+SAMPLE_USERS = 96
+SAMPLE_EVENTS = 8000
+FIRST_DAY = datetime(2018, 11, 1)
+DAYS = 30
+
+PAGES = ['Home', 'Settings', 'Logout', 'Login', 'About', 'Help', 'Downgrade', 'Upgrade', 'Thumbs Up', 'Add to Playlist']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA', 'Houston-The Woodlands-Sugar Land, TX']
+USER_AGENTS = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"',
+               'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; WOW64; Trident/6.0)']
+WORDS = ['love', 'night', 'fire', 'heart', 'river', 'blue', 'dream', 'road', 'light', 'rain', 'gold', 'song',
+         'wild', 'home', 'city', 'ghost', 'summer', 'dance', 'stone', 'sky']
+
+# columns of the Project2 event_data CSV files
+EVENT_CSV_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level',
+                     'location', 'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userId']
+
+
+def zipf_weights(n, skew):
+    """
+    Description: This function can be used to get Zipf-like weights, the k-th item weighs 1/k^skew,
+    so a few artists, users and songs take most of the activity
+
+    Arguments:
+        n: number of items.
+        skew: Zipf exponent, 0 for uniform.
+
+    Returns:
+        list of cumulative weights for random.choices
+    """
+
+    cum_weights, total = [], 0.0
+    for k in range(1, n + 1):
+        total += 1.0 / k ** skew
+        cum_weights.append(total)
+    return cum_weights
+
+
+def random_id(rng, prefix):
+    return prefix + ''.join(rng.choices(string.ascii_uppercase + string.digits, k=16))
+
+
+def random_title(rng):
+    return ' '.join(rng.choices(WORDS, k=rng.randint(1, 4))).title()
+
+
+def generate_songs(rng, num_songs, skew):
+    """
+    Description: This function can be used to generate the song catalog,
+    with songs spread over artists by a Zipf distribution
+
+    Arguments:
+        rng: random.Random object.
+        num_songs: number of songs.
+        skew: Zipf exponent of the number of songs per artist.
+
+    Returns:
+        list of song records in the song_data JSON format
+    """
+
+    artists = []
+    for i in range(max(1, num_songs // 2)):
+        latitude = rng.choice([None, round(rng.uniform(-60, 60), 5)])
+        artists.append({'artist_id': random_id(rng, 'AR'),
+                        'artist_name': '{} {}'.format(random_title(rng), i),
+                        'artist_location': rng.choice(['', 'California - LA', 'London, England', 'Detroit, MI']),
+                        'artist_latitude': latitude,
+                        'artist_longitude': None if latitude is None else round(rng.uniform(-120, 120), 5)})
+
+    cum_weights = zipf_weights(len(artists), skew)
+    songs = []
+    for artist in rng.choices(artists, cum_weights=cum_weights, k=num_songs):
+        song = {'num_songs': 1}
+        song.update(artist)
+        song.update({'song_id': random_id(rng, 'SO'),
+                     'title': random_title(rng),
+                     'duration': round(rng.uniform(60, 600), 5),
+                     'year': rng.choice([0, rng.randint(1960, 2010)])})
+        songs.append(song)
+
+    return songs
+
+
+def generate_users(rng, num_users):
+    first_names = ['Walter', 'Kaylee', 'Jacob', 'Lily', 'Chloe', 'Aleena', 'Tegan', 'Ryan', 'Jayden', 'Cienna']
+    last_names = ['Frye', 'Summers', 'Klein', 'Koch', 'Cuevas', 'Kirby', 'Levine', 'Smith', 'Graves', 'Freeman']
+    return [{'userId': str(i),
+             'firstName': rng.choice(first_names),
+             'lastName': rng.choice(last_names),
+             'gender': rng.choice('MF'),
+             'level': rng.choice(['free', 'free', 'paid']),
+             'location': rng.choice(LOCATIONS),
+             'userAgent': rng.choice(USER_AGENTS),
+             'registration': float(rng.randint(1535000000000, 1541000000000))}
+            for i in range(1, num_users + 1)]
+
+
+def generate_day(rng, day, num_events, users, user_weights, songs, song_weights, match_rate, session_ids):
+    """
+    Description: This function can be used to generate the events of one day.
+    Users are picked by a Zipf distribution and play sessions of geometric length,
+    NextSong events play a catalog song with probability match_rate, an unknown song otherwise.
+
+    Arguments:
+        rng: random.Random object.
+        day: datetime of the day.
+        num_events: number of events of the day.
+        users: users from generate_users.
+        user_weights: cumulative weights of the users.
+        songs: songs from generate_songs.
+        song_weights: cumulative weights of the songs.
+        match_rate: share of NextSong events playing a catalog song.
+        session_ids: list holding the next session id, shared by the days.
+
+    Returns:
+        list of events in the log_data JSON format, sorted by ts
+    """
+
+    start = int(day.timestamp() * 1000)
+    events = []
+    while len(events) < num_events:
+        user = rng.choices(users, cum_weights=user_weights)[0]
+        session_id = session_ids[0]
+        session_ids[0] += 1
+        ts = start + rng.randint(0, 86400000 - 1)
+
+        # a few anonymous events without a user, as in the real logs
+        logged_in = rng.random() > 0.02
+        session_length = min(int(rng.expovariate(1 / 15.0)) + 1, num_events - len(events))
+        for item in range(session_length):
+            if rng.random() < 0.85 and logged_in:
+                page = 'NextSong'
+                if rng.random() < match_rate:
+                    song = rng.choices(songs, cum_weights=song_weights)[0]
+                    artist, title, length = song['artist_name'], song['title'], song['duration']
+                else:
+                    artist, title, length = random_title(rng), random_title(rng), round(rng.uniform(60, 600), 5)
+            else:
+                page = rng.choice(PAGES)
+                artist, title, length = None, None, None
+
+            events.append({'artist': artist,
+                           'auth': 'Logged In' if logged_in else 'Logged Out',
+                           'firstName': user['firstName'] if logged_in else None,
+                           'gender': user['gender'] if logged_in else None,
+                           'itemInSession': item,
+                           'lastName': user['lastName'] if logged_in else None,
+                           'length': length,
+                           'level': user['level'],
+                           'location': user['location'] if logged_in else None,
+                           'method': 'PUT' if page == 'NextSong' else 'GET',
+                           'page': page,
+                           'registration': user['registration'] if logged_in else None,
+                           'sessionId': session_id,
+                           'song': title,
+                           'status': 200,
+                           'ts': ts,
+                           'userAgent': user['userAgent'] if logged_in else None,
+                           'userId': user['userId'] if logged_in else ''})
+            ts += int(rng.uniform(1000, 400000))
+
+    events.sort(key=lambda event: event['ts'])
+    return events
+
+
+def write_song_files(songs, output):
+    for song in songs:
+        track_id = random_id(random.Random(song['song_id']), 'TR')
+        directory = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+
+
+def write_log_file(events, day, output):
+    directory = os.path.join(output, 'log_data', day.strftime('%Y'), day.strftime('%m'))
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, day.strftime('%Y-%m-%d-events.json')), 'w') as f:
+        f.write('\n'.join(json.dumps(event, separators=(',', ':')) for event in events))
+
+
+def write_event_csv(events, day, output):
+    directory = os.path.join(output, 'event_data')
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, day.strftime('%Y-%m-%d-events.csv')), 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EVENT_CSV_COLUMNS)
+        for event in events:
+            writer.writerow(['' if event[column] is None else event[column] for column in EVENT_CSV_COLUMNS])
+
+
+def generate(output, scale, skew=1.1, match_rate=0.5, event_csv=False, seed=42):
+    """
+    Description: This function can be used to generate song_data and log_data (and optionally
+    the Project2 event_data CSV files) at scale times the size of the bundled sample
+
+    Arguments:
+        output: directory the data folders are written to.
+        scale: size relative to the bundled sample.
+        skew: Zipf exponent of artists, songs and users popularity.
+        match_rate: share of NextSong events playing a catalog song.
+        event_csv: also write the events as Project2 event_data CSV files.
+        seed: random seed, the same arguments always generate the same data.
+
+    Returns:
+        (number of songs, number of events)
+    """
+
+    rng = random.Random(seed)
+
+    songs = generate_songs(rng, int(SAMPLE_SONGS * scale), skew)
+    write_song_files(songs, output)
+
+    users = generate_users(rng, int(SAMPLE_USERS * scale))
+    user_weights = zipf_weights(len(users), skew)
+    song_weights = zipf_weights(len(songs), skew)
+
+    num_events = 0
+    session_ids = [1]
+    for d in range(DAYS):
+        day = FIRST_DAY + timedelta(days=d)
+        events = generate_day(rng, day, int(SAMPLE_EVENTS * scale / DAYS), users, user_weights,
+                              songs, song_weights, match_rate, session_ids)
+        write_log_file(events, day, output)
+        if event_csv:
+            write_event_csv(events, day, output)
+        num_events += len(events)
+
+    return len(songs), num_events
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate Sparkify song and log data at scale')
+    parser.add_argument('output', help='directory the song_data and log_data folders are written to')
+    parser.add_argument('--scale', type=float, default=10, help='size relative to the bundled sample')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of artists, songs and users')
+    parser.add_argument('--match-rate', type=float, default=0.5, help='share of NextSong events playing a catalog song')
+    parser.add_argument('--event-csv', action='store_true', help='also write the Project2 event_data CSV files')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    num_songs, num_events = generate(args.output, args.scale, args.skew, args.match_rate, args.event_csv, args.seed)
+    print('{} songs and {} events written to {}'.format(num_songs, num_events, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import sys
+import copy
+import time
+import threading
+import contextlib
+import psycopg2.extensions
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Description: Cursor counting the statements it sends to the database,
+    open it with conn.cursor(cursor_factory=CountingCursor).
+    """
+
+    round_trips = 0
+
+    def execute(self, query, vars=None):
+        self.round_trips += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        self.round_trips += len(vars_list)
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.round_trips += 1
+        return super().copy_expert(sql, file, size)
+
+
+class PipelineStats:
+    """
+    Description: Wall time, row counts, database round trips and bytes read
+    of every stage of every file of an ETL run, safe to share between threads.
+    Stages are recorded for the file each thread set with set_file.
+    """
+
+    fields = ('seconds', 'rows', 'round_trips', 'bytes')
+
+    # stages whose rows count as loaded in the progress line
+    loaded_stages = ('song load', 'songplay insert')
+
+    def __init__(self, progress=False):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.files = {}
+        self.progress = progress
+        self.start = time.perf_counter()
+        self.rows = 0
+
+    def set_file(self, filepath):
+        """
+        Description: This function can be used to set the file the next stages of the thread belong to.
+
+        Arguments:
+            filepath: data file path, or a name for work that spans files.
+
+        Returns:
+            None
+        """
+
+        self.local.filepath = filepath
+
+    @contextlib.contextmanager
+    def stage(self, name, cur=None):
+        """
+        Description: This function can be used to time a stage of the current file with a with block.
+        The block can add its rows and bytes to the yielded dict, the round trips of cur
+        during the block are counted when cur is a CountingCursor.
+
+        Arguments:
+            name: stage name, e.g. parse, filter, time build, user load, songplay lookup,
+                songplay insert or commit.
+            cur: the cursor object used in the block.
+
+        Returns:
+            context manager yielding a dict of rows, round_trips and bytes
+        """
+
+        filepath = getattr(self.local, 'filepath', 'run')
+        counts = {'rows': 0, 'round_trips': 0, 'bytes': 0}
+        round_trips = getattr(cur, 'round_trips', 0)
+        start = time.perf_counter()
+
+        yield counts
+
+        counts['seconds'] = time.perf_counter() - start
+        counts['round_trips'] += getattr(cur, 'round_trips', 0) - round_trips
+
+        with self.lock:
+            totals = self.files.setdefault(filepath, {}).setdefault(name, dict.fromkeys(self.fields, 0))
+            for field in self.fields:
+                totals[field] += counts[field]
+            if name in self.loaded_stages:
+                self.rows += counts['rows']
+
+    def print_progress(self):
+        """
+        Description: This function can be used to refresh the live progress line on stderr,
+        with the rows loaded so far and the rows loaded per second.
+
+        Returns:
+            None
+        """
+
+        if not self.progress:
+            return
+
+        elapsed = time.perf_counter() - self.start
+        sys.stderr.write('\r{} rows loaded, {:.0f} rows/s'.format(self.rows, self.rows / elapsed if elapsed else 0))
+        sys.stderr.flush()
+
+    def report(self):
+        """
+        Description: This function can be used to summarize the run.
+
+        Returns:
+            dict with the run wall time, the totals per stage and the totals per stage of every file
+        """
+
+        with self.lock:
+            stages = {}
+            for file_stages in self.files.values():
+                for name, counts in file_stages.items():
+                    totals = stages.setdefault(name, dict.fromkeys(self.fields, 0))
+                    for field in self.fields:
+                        totals[field] += counts[field]
+
+            return {'seconds': time.perf_counter() - self.start,
+                    'stages': stages,
+                    'files': copy.deepcopy(self.files)}
@@ -4,6 +4,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+file_manifest_drop = "DROP TABLE IF EXISTS file_manifest"
 
 
 # CREATE TABLES
@@ -17,18 +18,29 @@ artist_id VARCHAR(100) REFERENCES artists(artist_id),
 session_id BIGINT,
 location VARCHAR(255),
 user_agent TEXT,
+source_file VARCHAR,
 PRIMARY KEY (songplay_id))
 """)
 
+# songplays of a log file, deleted before the file is loaded again
+songplay_source_file_index = "CREATE INDEX IF NOT EXISTS songplays_source_file ON songplays (source_file)"
+
+# tables created before songplays had a source_file get it with its index
+songplay_source_file_add = "ALTER TABLE songplays ADD COLUMN IF NOT EXISTS source_file VARCHAR"
+
 user_table_create = ("""CREATE TABLE users(
 user_id VARCHAR NOT NULL,
 firstName VARCHAR(255) NOT NULL,
 lastName VARCHAR(255) NOT NULL,
 gender VARCHAR(1),
 level VARCHAR(50),
+level_ts BIGINT,
 PRIMARY KEY (user_id))
 """)
 
+# tables created before users had a level_ts get it
+user_level_ts_add = "ALTER TABLE users ADD COLUMN IF NOT EXISTS level_ts BIGINT"
+
 song_table_create = ("""CREATE TABLE songs(
 song_id VARCHAR(100) NOT NULL,
 title VARCHAR(255) NOT NULL,
@@ -59,12 +71,55 @@ weekday INTEGER,
 PRIMARY KEY (start_time))
 """)
 
+# One record per data file, written in the same transaction as the data of the file,
+# so reruns only load new or changed files and resume after the last committed file
+file_manifest_create = ("""CREATE TABLE IF NOT EXISTS file_manifest(
+filepath VARCHAR NOT NULL,
+size BIGINT,
+mtime DOUBLE PRECISION,
+md5 VARCHAR(32),
+status VARCHAR(10),
+loaded_at TIMESTAMP DEFAULT now(),
+PRIMARY KEY (filepath))
+""")
+
 # INSERT RECORDS
-songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
- VALUES (%s, %s, %s, %s, %s, %s, %s, %s) """)
+songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent, source_file) 
+ VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) """)
 
-user_table_insert = ("""INSERT INTO users (user_id, firstName, lastName, gender, level) VALUES (%s, %s, %s, %s, %s) 
-ON CONFLICT (user_id) DO UPDATE SET firstName=users.firstName, lastName=users.lastName, gender=users.gender, level=users.level """)
+# INSERT MANY RECORDS AT ONCE, VALUES ARE FILLED IN BY psycopg2.extras.execute_values
+# the level of a user is the level of their latest event (level_ts), whatever order the files are loaded in
+user_table_bulk_insert = ("""INSERT INTO users (user_id, firstName, lastName, gender, level, level_ts) VALUES %s
+ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level, level_ts=EXCLUDED.level_ts
+WHERE users.level_ts IS NULL OR EXCLUDED.level_ts > users.level_ts """)
+
+song_table_bulk_insert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) VALUES %s
+ON CONFLICT (song_id) DO UPDATE SET title=songs.title, artist_id=songs.artist_id,
+year=songs.year, duration=songs.duration """)
+
+artist_table_bulk_insert = ("""INSERT INTO artists (artist_id, name, location, latitude, longitude) VALUES %s
+ON CONFLICT (artist_id) DO UPDATE SET name=artists.name, location=artists.location, latitude=artists.latitude,
+longitude=artists.longitude """)
+
+time_table_bulk_insert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday) VALUES %s
+ON CONFLICT (start_time) DO UPDATE SET hour=time.hour, day=time.day, week=time.week, month=time.month,
+year=time.year, weekday=time.weekday """)
+
+file_manifest_insert = ("""INSERT INTO file_manifest (filepath, size, mtime, md5, status) VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (filepath) DO UPDATE SET size=EXCLUDED.size, mtime=EXCLUDED.mtime, md5=EXCLUDED.md5,
+status=EXCLUDED.status, loaded_at=now() """)
+
+file_manifest_bulk_insert = ("""INSERT INTO file_manifest (filepath, size, mtime, md5, status) VALUES %s
+ON CONFLICT (filepath) DO UPDATE SET size=EXCLUDED.size, mtime=EXCLUDED.mtime, md5=EXCLUDED.md5,
+status=EXCLUDED.status, loaded_at=now() """)
+
+# COPY RECORDS
+songplay_table_copy = ("""COPY songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent, source_file)
+FROM STDIN WITH (FORMAT csv, NULL '\\N') """)
+
+user_table_insert = ("""INSERT INTO users (user_id, firstName, lastName, gender, level, level_ts) VALUES (%s, %s, %s, %s, %s, %s)
+ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level, level_ts=EXCLUDED.level_ts
+WHERE users.level_ts IS NULL OR EXCLUDED.level_ts > users.level_ts """)
 
 song_table_insert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) VALUES (%s, %s, %s, %s, %s)
 ON CONFLICT (song_id) DO UPDATE SET title=songs.title, artist_id=songs.artist_id,
@@ -78,6 +133,9 @@ time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, ye
 ON CONFLICT (start_time) DO UPDATE SET hour=time.hour, day=time.day, week=time.week, month=time.month, 
 year=time.year, weekday=time.weekday """)
 
+# DELETE THE SONGPLAYS OF AN EARLIER LOAD OF A LOG FILE
+songplay_file_delete = "DELETE FROM songplays WHERE source_file = %s"
+
 # FIND SONGS BY SONG_ID AND ARTIST_ID
 song_select_by_song_id_artist_id = ("""SELECT s.song_id, a.artist_id FROM songs s, artists a
 WHERE s.artist_id = a.artist_id  
@@ -86,6 +144,16 @@ WHERE s.artist_id = a.artist_id
     AND s.duration = %s
 """)
 
+# ALL SONGS WITH THEIR ARTIST NAME, TO BUILD THE IN-MEMORY SONG INDEX
+song_index_select = ("""SELECT s.title, a.name, s.duration, s.song_id, a.artist_id FROM songs s, artists a
+WHERE s.artist_id = a.artist_id
+""")
+
+# FILES ALREADY LOADED
+file_manifest_select = ("""SELECT filepath, size, mtime, md5 FROM file_manifest
+WHERE status = 'loaded'
+""")
+
 # FIND SONG BY ID
 song_select = ("""SELECT COUNT(*) FROM songs s
 WHERE s.song_id = %s
@@ -107,5 +175,5 @@ WHERE t.start_time = %s
 """)
 
 # QUERY LISTS
-create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_table_drop]
\ No newline at end of file
+create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, songplay_source_file_index, file_manifest_create]
+drop_table_queries = [user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_table_drop, file_manifest_drop]
\ No newline at end of file
@@ -0,0 +1,103 @@
+import os
+import glob
+import shutil
+import functools
+import psycopg2
+import pytest
+from sql_queries import create_table_queries
+from etl import process_data, process_data_parallel, process_log_file, read_log_file, load_log_file
+
+"""
+Reload tests of etl.py against a sparkifytestdb database created for the run,
+skipped when the student database of the README is not reachable
+"""
+
+DSN = "host=127.0.0.1 dbname=sparkifytestdb user=student password=student"
+LOG_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'log_data')
+
+
+@pytest.fixture
+def conn():
+    try:
+        admin = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    except psycopg2.OperationalError as error:
+        pytest.skip('no student database: {}'.format(error))
+    admin.set_session(autocommit=True)
+    admin.cursor().execute("DROP DATABASE IF EXISTS sparkifytestdb")
+    admin.cursor().execute("CREATE DATABASE sparkifytestdb WITH ENCODING 'utf8' TEMPLATE template0")
+
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+    for query in create_table_queries:
+        cur.execute(query)
+    conn.commit()
+    yield conn
+
+    conn.close()
+    admin.cursor().execute("DROP DATABASE IF EXISTS sparkifytestdb")
+    admin.close()
+
+
+@pytest.fixture
+def log_data(tmp_path):
+    # a few log files, copied as the tests modify them
+    for filepath in sorted(glob.glob(os.path.join(LOG_DATA, '*', '*', '*.json')))[:3]:
+        shutil.copy(filepath, str(tmp_path))
+    return str(tmp_path)
+
+
+def table_counts(cur):
+    counts = {}
+    for table in ['songplays', 'users', 'time', 'file_manifest']:
+        cur.execute("SELECT COUNT(*) FROM {}".format(table))
+        counts[table] = cur.fetchone()[0]
+    return counts
+
+
+def modify_first_file(log_data):
+    # a new size, mtime and md5 with the same events
+    with open(sorted(glob.glob(os.path.join(log_data, '*.json')))[0], 'a') as f:
+        f.write('\n')
+
+
+def test_modified_file_reload_keeps_counts(conn, log_data):
+    cur = conn.cursor()
+    load = functools.partial(process_data, cur, conn, log_data, functools.partial(process_log_file, bulk=True),
+                             checkpoint=True)
+    load()
+    counts = table_counts(cur)
+    assert counts['songplays'] > 0
+
+    modify_first_file(log_data)
+    load()
+    assert table_counts(cur) == counts
+
+
+def test_modified_file_parallel_reload_keeps_counts(conn, log_data):
+    cur = conn.cursor()
+    load = functools.partial(process_data_parallel, DSN, log_data, read_log_file,
+                             functools.partial(load_log_file, bulk=True), 2, checkpoint=True)
+    load()
+    counts = table_counts(cur)
+    conn.commit()
+    assert counts['songplays'] > 0
+
+    modify_first_file(log_data)
+    load()
+    assert table_counts(cur) == counts
+
+
+def test_parallel_users_match_serial(conn):
+    cur = conn.cursor()
+    users = []
+    for load in [functools.partial(process_data, cur, conn, LOG_DATA, functools.partial(process_log_file, bulk=True)),
+                 functools.partial(process_data_parallel, DSN, LOG_DATA, read_log_file,
+                                   functools.partial(load_log_file, bulk=True), 4)]:
+        cur.execute("TRUNCATE songplays, users, time")
+        conn.commit()
+        load()
+        cur.execute("SELECT user_id, firstName, lastName, gender, level FROM users ORDER BY user_id")
+        users.append(cur.fetchall())
+        conn.commit()
+
+    assert users[0] and users[0] == users[1]
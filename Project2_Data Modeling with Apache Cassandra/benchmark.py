@@ -0,0 +1,186 @@
+import time
+import heapq
+import random
+import argparse
+import threading
+from cassandra import OperationTimedOut
+from cassandra.cluster import Cluster
+from cassandra.query import BatchStatement, SimpleStatement
+from cql_queries import *
+from etl import TABLE_INSERTS, load_rows, load_rows_batched
+from etl import read_event_datafile, read_event_files, get_event_files, project_events
+
+
+class SimulatedFuture:
+    """
+    Description: Stand-in for the driver's ResponseFuture, completed by SimulatedSession.
+    """
+
+    def __init__(self):
+        self.callback = None
+        self.errback = None
+        self.outcome = None
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        self.callback = (callback, callback_args)
+        self.errback = (errback, errback_args)
+
+    def complete(self, error=None):
+        if error is None:
+            self.callback[0](None, *self.callback[1])
+        else:
+            self.errback[0](error, *self.errback[1])
+
+
+class SimulatedSession:
+    """
+    Description: Stand-in for a Cassandra session when no cluster is available.
+    Every request takes latency seconds plus statement_cost seconds per statement it holds,
+    at most concurrency requests are served at once and a share timeout_rate of them fail
+    with OperationTimedOut, so the throughput of a client grows with its window until
+    the simulated cluster is saturated.
+    """
+
+    def __init__(self, latency=0.002, concurrency=64, timeout_rate=0.0, statement_cost=0.0001, seed=42):
+        self.latency = latency
+        self.statement_cost = statement_cost
+        self.timeout_rate = timeout_rate
+        self.random = random.Random(seed)
+        self.slots = [0.0] * concurrency
+        self.pending = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.requests = 0
+        self.thread = threading.Thread(target=self._complete, daemon=True)
+        self.thread.start()
+
+    def prepare(self, query):
+        # a simple statement can be added to a BatchStatement without a cluster to prepare it on
+        return SimpleStatement(query.replace('?', '%s'))
+
+    def execute_async(self, statement, params=None):
+        future = SimulatedFuture()
+        with self.condition:
+            self.requests += 1
+            # the request waits for the first free slot of the cluster, then takes its service time
+            statements = len(statement) if isinstance(statement, BatchStatement) else 1
+            due = max(time.perf_counter(), heapq.heappop(self.slots)) + self.latency + statements * self.statement_cost
+            heapq.heappush(self.slots, due)
+            error = OperationTimedOut() if self.random.random() < self.timeout_rate else None
+            self.sequence += 1
+            heapq.heappush(self.pending, (due, self.sequence, future, error))
+            self.condition.notify()
+        return future
+
+    def _complete(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                due, _, future, error = self.pending[0]
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.pending)
+            # callbacks run outside the lock, like on the driver's event loop thread
+            future.complete(error)
+
+
+def benchmark_windows(session, rows, windows, max_retries=5):
+    """
+    Description: This function can be used to load the rows once per window size and print the statements per second.
+
+    Arguments:
+        session: Cassandra session object or SimulatedSession.
+        rows: list of event_datafile_new.csv rows.
+        windows: window sizes to compare.
+        max_retries: number of times a timed out request is sent again.
+
+    Returns:
+        None
+    """
+
+    print('{:>8} {:>10} {:>9} {:>12} {:>8} {:>7}'.format('window', 'statements', 'seconds', 'statements/s', 'retries', 'failed'))
+    for window in windows:
+        start = time.perf_counter()
+        sent, retries, errors = load_rows(session, rows, window=window, max_retries=max_retries)
+        elapsed = time.perf_counter() - start
+        print('{:>8} {:>10} {:>9.2f} {:>12.0f} {:>8} {:>7}'.format(window, sent, elapsed, sent / elapsed, retries, len(errors)))
+
+
+def benchmark_batches(session, rows, batch_sizes, window, max_retries=5):
+    """
+    Description: This function can be used to load the rows once per batch size, 0 for single-row
+    async writes, and print the inserts and requests per second.
+
+    Arguments:
+        session: Cassandra session object or SimulatedSession.
+        rows: list of event_datafile_new.csv rows.
+        batch_sizes: maximum statements per partition batch to compare.
+        window: maximum number of requests in flight.
+        max_retries: number of times a timed out request is sent again.
+
+    Returns:
+        None
+    """
+
+    inserts = len(rows) * len(TABLE_INSERTS)
+    print('{:>10} {:>10} {:>10} {:>9} {:>10} {:>8} {:>7}'.format(
+        'batch size', 'inserts', 'requests', 'seconds', 'inserts/s', 'retries', 'failed'))
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        if batch_size:
+            sent, retries, errors = load_rows_batched(session, rows, window=window, max_retries=max_retries,
+                                                      batch_size=batch_size)
+        else:
+            sent, retries, errors = load_rows(session, rows, window=window, max_retries=max_retries)
+        elapsed = time.perf_counter() - start
+        print('{:>10} {:>10} {:>10} {:>9.2f} {:>10.0f} {:>8} {:>7}'.format(
+            batch_size or 'single', inserts, sent, elapsed, inserts / elapsed, retries, len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the async loader window sizes or partition batch sizes')
+    parser.add_argument('--event-data', default='event_data', help='directory of the daily event files')
+    parser.add_argument('--file', help='read this merged event data file instead of the event_data files')
+    parser.add_argument('--host', help='Cassandra contact point, a simulated cluster is used when omitted')
+    parser.add_argument('--windows', type=int, nargs='+', default=[1, 8, 32, 128, 512])
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        help='compare partition batch sizes (0 for single-row writes) at the first window size')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per request of the simulated cluster')
+    parser.add_argument('--concurrency', type=int, default=64, help='requests served at once by the simulated cluster')
+    parser.add_argument('--timeout-rate', type=float, default=0.001,
+                        help='share of the simulated requests timing out')
+    parser.add_argument('--statement-cost', type=float, default=0.0001,
+                        help='seconds per statement of a simulated request')
+    args = parser.parse_args()
+
+    # every run loads the same rows, so they are read once
+    if args.file:
+        rows = list(read_event_datafile(args.file))
+    else:
+        rows = list(project_events(read_event_files(get_event_files(args.event_data))))
+
+    if args.host:
+        cluster = Cluster([args.host])
+        session = cluster.connect()
+        session.execute(keyspace_create)
+        session.set_keyspace('sparkify')
+        for query in create_table_queries:
+            session.execute(query)
+    else:
+        session = SimulatedSession(args.latency, args.concurrency, args.timeout_rate, args.statement_cost)
+
+    if args.batch_sizes:
+        benchmark_batches(session, rows, args.batch_sizes, args.windows[0])
+    else:
+        benchmark_windows(session, rows, args.windows)
+
+    if args.host:
+        session.shutdown()
+        cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
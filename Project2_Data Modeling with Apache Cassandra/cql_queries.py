@@ -0,0 +1,70 @@
+# KEYSPACE
+keyspace_create = ("""CREATE KEYSPACE IF NOT EXISTS sparkify
+WITH REPLICATION = { 'class' : 'SimpleStrategy', 'replication_factor' : 1 }
+""")
+
+
+# DROP TABLES
+song_data_by_session_drop = "DROP TABLE IF EXISTS song_data_by_session"
+song_by_userid_and_sessionid_drop = "DROP TABLE IF EXISTS song_by_userid_and_sessionid"
+song_by_username_drop = "DROP TABLE IF EXISTS song_by_username"
+
+
+# CREATE TABLES
+# Query 1: artist, song title and song's length heard during sessionId = 338, and itemInSession = 4
+song_data_by_session_create = ("""CREATE TABLE IF NOT EXISTS song_data_by_session(
+sessionId INT,
+itemInSession INT,
+artist TEXT,
+song TEXT,
+length DOUBLE,
+PRIMARY KEY ((sessionId, itemInSession)))
+""")
+
+# Query 2: artist, song (sorted by itemInSession) and user name for userid = 10, sessionid = 182
+song_by_userid_and_sessionid_create = ("""CREATE TABLE IF NOT EXISTS song_by_userid_and_sessionid(
+userId INT,
+sessionId INT,
+itemInSession INT,
+artist TEXT,
+song TEXT,
+firstName TEXT,
+lastName TEXT,
+PRIMARY KEY ((userId, sessionId), itemInSession))
+""")
+
+# Query 3: every user name who listened to the song 'All Hands Against His Own'
+song_by_username_create = ("""CREATE TABLE IF NOT EXISTS song_by_username(
+song TEXT,
+firstName TEXT,
+lastName TEXT,
+PRIMARY KEY (song, firstName, lastName))
+""")
+
+
+# INSERT RECORDS
+# prepared once per session, so the values are bound with ? markers
+song_data_by_session_insert = ("""INSERT INTO song_data_by_session (sessionId, itemInSession, artist, song, length)
+VALUES (?, ?, ?, ?, ?)
+""")
+
+song_by_userid_and_sessionid_insert = ("""INSERT INTO song_by_userid_and_sessionid (userId, sessionId, itemInSession,
+artist, song, firstName, lastName)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+""")
+
+song_by_username_insert = ("""INSERT INTO song_by_username (song, firstName, lastName)
+VALUES (?, ?, ?)
+""")
+
+
+# SELECT RECORDS
+song_data_by_session_select = "SELECT artist, song, length FROM song_data_by_session WHERE sessionId = %s AND itemInSession = %s"
+song_by_userid_and_sessionid_select = ("SELECT artist, song, firstName, lastName FROM song_by_userid_and_sessionid "
+                                       "WHERE userId = %s AND sessionId = %s")
+song_by_username_select = "SELECT firstName, lastName FROM song_by_username WHERE song = %s"
+
+
+# QUERY LISTS
+create_table_queries = [song_data_by_session_create, song_by_userid_and_sessionid_create, song_by_username_create]
+drop_table_queries = [song_data_by_session_drop, song_by_userid_and_sessionid_drop, song_by_username_drop]
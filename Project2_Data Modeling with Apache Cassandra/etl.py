@@ -0,0 +1,368 @@
+import os
+import csv
+import glob
+import time
+import argparse
+import itertools
+import threading
+from cassandra import OperationTimedOut, Timeout, Unavailable
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
+from cassandra.query import BatchStatement, BatchType
+from cql_queries import *
+
+# errors worth sending the same statement again for, the insert statements are idempotent
+RETRYABLE_ERRORS = (OperationTimedOut, Timeout, Unavailable)
+
+# columns of event_datafile_new.csv: artist, firstName, gender, itemInSession, lastName, length,
+# level, location, sessionId, song, userId
+TABLE_INSERTS = {
+    'song_data_by_session': (song_data_by_session_insert,
+                             lambda line: (int(line[8]), int(line[3]), line[0], line[9], float(line[5]))),
+    'song_by_userid_and_sessionid': (song_by_userid_and_sessionid_insert,
+                                     lambda line: (int(line[10]), int(line[8]), int(line[3]),
+                                                   line[0], line[9], line[1], line[4])),
+    'song_by_username': (song_by_username_insert,
+                         lambda line: (line[9], line[1], line[4])),
+}
+
+# partition key of every table, rows with the same key are stored on the same replicas
+TABLE_PARTITION_KEYS = {
+    'song_data_by_session': lambda line: (line[8], line[3]),
+    'song_by_userid_and_sessionid': lambda line: (line[10], line[8]),
+    'song_by_username': lambda line: line[9],
+}
+
+
+class AsyncWriter:
+    """
+    Description: Sends statements with execute_async keeping at most window requests in flight.
+    execute blocks while the window is full, so reading the input never runs ahead of the cluster,
+    and requests failing with a timeout or an unavailable replica are sent again after a backoff.
+    """
+
+    def __init__(self, session, window=128, max_retries=5, backoff=0.1):
+        self.session = session
+        self.window = threading.BoundedSemaphore(window)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.in_flight = 0
+        self.sent = 0
+        self.retries = 0
+        self.errors = []
+
+    def execute(self, statement, params=None):
+        """
+        Description: This function can be used to send one statement, waiting for a free slot of the window.
+
+        Arguments:
+            statement: prepared (or batch) statement.
+            params: values bound to the statement.
+
+        Returns:
+            None
+        """
+
+        self.window.acquire()
+        with self.lock:
+            self.in_flight += 1
+            self.sent += 1
+        self._send(statement, params, 0)
+
+    def _send(self, statement, params, attempt):
+        try:
+            future = self.session.execute_async(statement, params)
+        except Exception as e:
+            self._failed(e, statement, params, attempt)
+            return
+        future.add_callbacks(self._done, self._failed, errback_args=(statement, params, attempt))
+
+    def _done(self, result=None):
+        with self.lock:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.notify_all()
+        self.window.release()
+
+    def _failed(self, error, statement, params, attempt):
+        if isinstance(error, RETRYABLE_ERRORS) and attempt < self.max_retries:
+            with self.lock:
+                self.retries += 1
+            # the callback runs on the driver's event loop, so the retry is sent from a timer thread
+            timer = threading.Timer(self.backoff * 2 ** attempt, self._send, (statement, params, attempt + 1))
+            timer.daemon = True
+            timer.start()
+            return
+
+        with self.lock:
+            self.errors.append((error, params))
+        self._done()
+
+    def flush(self):
+        """
+        Description: This function can be used to wait until every statement sent has completed.
+
+        Returns:
+            list of (error, params) of the statements that failed after all retries
+        """
+
+        with self.lock:
+            while self.in_flight:
+                self.idle.wait()
+            return list(self.errors)
+
+
+# columns kept from the event_data files, in the order of event_datafile_new.csv
+EVENT_DATAFILE_COLUMNS = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                          'level', 'location', 'sessionId', 'song', 'userId']
+EVENT_COLUMN_INDEXES = [0, 2, 3, 4, 5, 6, 7, 8, 12, 13, 16]
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def get_event_files(filepath):
+    """
+    Description: This function can be used to list the daily event files in the filepath (event_data)
+
+    Arguments:
+        filepath: event_data directory.
+
+    Returns:
+        sorted list of CSV file paths
+    """
+
+    return sorted(glob.glob(os.path.join(filepath, '*.csv')))
+
+
+def read_event_files(path_list):
+    """
+    Description: This function can be used to read the rows of every event file one after the other,
+    only one row is held in memory at a time whatever the number of files
+
+    Arguments:
+        path_list: event file paths.
+
+    Returns:
+        generator of rows, without the headers
+    """
+
+    for filepath in path_list:
+        with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+            csvreader = csv.reader(csvfile)
+            next(csvreader)
+            for line in csvreader:
+                yield line
+
+
+def project_events(rows):
+    """
+    Description: This function can be used to keep the event_datafile_new.csv columns of the events
+    that played a song (artist set)
+
+    Arguments:
+        rows: iterable of event_data rows.
+
+    Returns:
+        generator of event_datafile_new.csv rows
+    """
+
+    for row in rows:
+        if row[0] == '':
+            continue
+        yield [row[i] for i in EVENT_COLUMN_INDEXES]
+
+
+def spill_event_datafile(rows, filepath):
+    """
+    Description: This function can be used to write the rows passing through to the file in the filepath
+    (event_datafile_new.csv) while handing them on, so the merged file is written in the same pass as the load
+
+    Arguments:
+        rows: iterable of event_datafile_new.csv rows.
+        filepath: merged file path.
+
+    Returns:
+        generator of the same rows
+    """
+
+    with open(filepath, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(EVENT_DATAFILE_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+
+def read_event_datafile(filepath):
+    """
+    Description: This function can be used to read the rows of the file in the filepath (event_datafile_new.csv)
+
+    Arguments:
+        filepath: event_datafile_new.csv file path.
+
+    Returns:
+        generator of rows, without the header
+    """
+
+    with open(filepath, encoding='utf8') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)
+        for line in csvreader:
+            yield line
+
+
+def load_rows(session, rows, tables=tuple(TABLE_INSERTS), window=128, max_retries=5):
+    """
+    Description: This function can be used to insert every row into the query tables,
+    preparing each INSERT statement once and sending the rows through an AsyncWriter.
+
+    Arguments:
+        session: the Cassandra session object, with the keyspace set.
+        rows: iterable of event_datafile_new.csv rows.
+        tables: names of the tables to load, keys of TABLE_INSERTS.
+        window: maximum number of requests in flight.
+        max_retries: number of times a timed out request is sent again.
+
+    Returns:
+        (number of statements sent, number of retries, list of (error, params) that failed)
+    """
+
+    prepared = [(session.prepare(TABLE_INSERTS[table][0]), TABLE_INSERTS[table][1]) for table in tables]
+    writer = AsyncWriter(session, window, max_retries)
+
+    for line in rows:
+        for statement, values in prepared:
+            writer.execute(statement, values(line))
+
+    errors = writer.flush()
+    return writer.sent, writer.retries, errors
+
+
+def partition_batches(statement, values, partition_key, rows, batch_size):
+    """
+    Description: This function can be used to group rows by partition key into UNLOGGED batches
+    of at most batch_size statements. A batch only touches one partition, so its coordinator is a replica
+    of that partition (the batch is routed by the token of its first statement) and it is applied
+    as a single mutation; partitions with one row are sent as a plain statement.
+
+    Arguments:
+        statement: prepared INSERT statement.
+        values: function returning the statement values of a row.
+        partition_key: function returning the partition key of a row.
+        rows: list of event_datafile_new.csv rows.
+        batch_size: maximum number of statements in a batch.
+
+    Returns:
+        generator of (statement or batch, values or None)
+    """
+
+    partitions = {}
+    for line in rows:
+        partitions.setdefault(partition_key(line), []).append(values(line))
+
+    for params_list in partitions.values():
+        for i in range(0, len(params_list), batch_size):
+            chunk = params_list[i:i + batch_size]
+            if len(chunk) == 1:
+                yield statement, chunk[0]
+                continue
+
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for params in chunk:
+                batch.add(statement, params)
+            yield batch, None
+
+
+def load_rows_batched(session, rows, tables=tuple(TABLE_INSERTS), window=128, max_retries=5,
+                      batch_size=20, group_rows=5000):
+    """
+    Description: This function can be used to insert every row into the query tables
+    with one request per partition instead of one request per row. The rows are read group_rows at a time,
+    grouped by partition key and sent as UNLOGGED batches through an AsyncWriter.
+
+    Arguments:
+        session: the Cassandra session object, with the keyspace set.
+        rows: iterable of event_datafile_new.csv rows.
+        tables: names of the tables to load, keys of TABLE_INSERTS.
+        window: maximum number of requests in flight.
+        max_retries: number of times a timed out request is sent again.
+        batch_size: maximum number of statements in a batch, keep batches under the
+            batch_size_warn_threshold_in_kb of the cluster (5 kB by default).
+        group_rows: number of rows grouped at a time, bounds the memory used.
+
+    Returns:
+        (number of requests sent, number of retries, list of (error, params) that failed)
+    """
+
+    prepared = [(session.prepare(TABLE_INSERTS[table][0]), TABLE_INSERTS[table][1], TABLE_PARTITION_KEYS[table])
+                for table in tables]
+    writer = AsyncWriter(session, window, max_retries)
+
+    rows = iter(rows)
+    while True:
+        group = list(itertools.islice(rows, group_rows))
+        if not group:
+            break
+        for statement, values, partition_key in prepared:
+            for request, params in partition_batches(statement, values, partition_key, group, batch_size):
+                writer.execute(request, params)
+
+    errors = writer.flush()
+    return writer.sent, writer.retries, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load the event data into the sparkify keyspace')
+    parser.add_argument('--host', default='127.0.0.1', help='Cassandra contact point')
+    parser.add_argument('--event-data', default='event_data', help='directory of the daily event files')
+    parser.add_argument('--file', help='load this merged event data file instead of the event_data files')
+    parser.add_argument('--spill', metavar='FILE',
+                        help='also write the rows streamed from the event_data files to FILE, e.g. event_datafile_new.csv')
+    parser.add_argument('--window', type=int, default=128, help='maximum number of requests in flight')
+    parser.add_argument('--retries', type=int, default=5, help='number of times a timed out request is sent again')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='send the rows of a partition as UNLOGGED batches of at most this many statements')
+    parser.add_argument('--group-rows', type=int, default=5000,
+                        help='number of rows grouped by partition at a time with --batch-size')
+    args = parser.parse_args()
+
+    # requests go straight to a replica of the partition they write
+    profile = ExecutionProfile(load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    cluster = Cluster([args.host], execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    session = cluster.connect()
+
+    session.execute(keyspace_create)
+    session.set_keyspace('sparkify')
+    for query in create_table_queries:
+        session.execute(query)
+
+    # rows stream from the files into the writers, memory does not grow with the number of files
+    if args.file:
+        rows = read_event_datafile(args.file)
+    else:
+        rows = project_events(read_event_files(get_event_files(args.event_data)))
+        if args.spill:
+            rows = spill_event_datafile(rows, args.spill)
+
+    start = time.perf_counter()
+    if args.batch_size:
+        sent, retries, errors = load_rows_batched(session, rows, window=args.window, max_retries=args.retries,
+                                                  batch_size=args.batch_size, group_rows=args.group_rows)
+    else:
+        sent, retries, errors = load_rows(session, rows,
+                                          window=args.window, max_retries=args.retries)
+    elapsed = time.perf_counter() - start
+
+    print('{} requests in {:.2f} s ({:.0f}/s), {} retries, {} failed'.format(
+        sent, elapsed, sent / elapsed, retries, len(errors)))
+    for error, params in errors[:10]:
+        print(params, error)
+
+    session.shutdown()
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
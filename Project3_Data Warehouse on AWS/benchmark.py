@@ -0,0 +1,243 @@
+import io
+import re
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import configparser
+from sql_queries import create_table_queries, drop_table_queries, copy_table_queries, insert_table_queries
+from sql_queries import time_select, songplay_select
+from profiling import plan_details
+from standins import connect_local, seed_local_storage
+
+sys.path.append('../Project1_Data_Modeling_with_Postgres')
+from generate_data import generate
+
+TABLES = ['users', 'songs', 'artists', 'time', 'songplays']
+
+# the NOT IN anti-join inserts the staged upserts replaced, kept as the baseline
+antijoin_insert_queries = [["""INSERT INTO users (userId, firstName, lastName, gender, level)
+    SELECT DISTINCT userId, firstName, lastName, gender, level
+    FROM staging_events
+    WHERE page = 'NextSong'
+    AND userId NOT IN (SELECT DISTINCT userId FROM users)
+"""], ["""INSERT INTO songs (song_id, title, artist_id, year, duration)
+    SELECT DISTINCT song_id, title, artist_id, year, duration
+    FROM staging_songs
+    WHERE song_id NOT IN (SELECT DISTINCT song_id FROM songs)
+"""], ["""INSERT INTO artists (artist_id, name, location, latitude, longitude)
+    SELECT DISTINCT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+    FROM staging_songs
+    WHERE artist_id NOT IN (SELECT DISTINCT artist_id FROM artists)
+"""], ["""INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    SELECT start_time, EXTRACT(hour from start_time), EXTRACT(day from start_time), EXTRACT(week from start_time),
+        EXTRACT(month from start_time), EXTRACT(year from start_time), EXTRACT(dow from start_time)
+    FROM (SELECT DISTINCT TIMESTAMP 'epoch' + CAST(ts AS BIGINT)/1000 *INTERVAL '1 second' as start_time
+          FROM staging_events) AS time_new
+    WHERE start_time NOT IN (SELECT DISTINCT start_time FROM time)
+"""], ["""INSERT INTO songplays (start_time, userId, level, song_id, artist_id, sessionId, location, userAgent)
+    SELECT DISTINCT TIMESTAMP 'epoch' + CAST(e.ts AS BIGINT)/1000 *INTERVAL '1 second' as start_time,
+        e.userId, e.level, s.song_id, s.artist_id, e.sessionId, e.location, e.userAgent
+    FROM staging_events e, staging_songs s
+    WHERE e.page = 'NextSong'
+    AND e.song = s.title
+    AND e.length = s.duration
+    AND e.artist = s.artist_name
+    AND (e.userId, e.sessionId, TIMESTAMP 'epoch' + CAST(e.ts AS BIGINT)/1000 *INTERVAL '1 second')
+        NOT IN (SELECT DISTINCT userId, sessionId, start_time FROM songplays)
+"""]]
+
+bigint_ts_selects = [("time", time_select), ("songplays", songplay_select.format(songs='staging_songs'))]
+# the same selects converting the VARCHAR ts of every row, as they were before ts was staged as a BIGINT
+varchar_ts_selects = [(table, re.sub(r'\b(e\.)?ts/1000', r'CAST(\1ts AS BIGINT)/1000', query).
+                       replace('staging_events', 'staging_events_varchar')) for table, query in bigint_ts_selects]
+
+
+def load_increment(cur, conn, config, scale, seed):
+    """
+    Description: This function can be used to generate a new increment of song and log data,
+    copy it to the S3 stand-in and load it into the emptied staging tables
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        config: dwh.cfg ConfigParser.
+        scale: size of the increment relative to the Project1 sample.
+        seed: random seed of the increment.
+
+    Returns:
+        None
+    """
+
+    with tempfile.TemporaryDirectory() as data:
+        # the same users come back in every increment, the songs and sessions are new
+        generate(data, scale, seed=seed)
+        seed_local_storage(config, data)
+
+    cur.execute("TRUNCATE staging_events, staging_songs")
+    for query in copy_table_queries:
+        cur.execute(query)
+    # fresh statistics, so the staging joins get the same plan in every run
+    cur.execute("ANALYZE staging_events")
+    cur.execute("ANALYZE staging_songs")
+    conn.commit()
+
+
+def time_inserts(cur, conn, queries):
+    """
+    Description: This function can be used to time the statements of every table, one transaction per table
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        queries: list of statement lists, in the order of TABLES.
+
+    Returns:
+        list of seconds per table
+    """
+
+    seconds = []
+    for table_queries in queries:
+        start = time.perf_counter()
+        for query in table_queries:
+            cur.execute(query)
+        conn.commit()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def grow_staging_events(cur, conn, rows):
+    """
+    Description: This function can be used to double the staged events until there are at least rows of them,
+    every copy is shifted one day later so the copies have their own timestamps
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        rows: number of events wanted.
+
+    Returns:
+        number of staged events
+    """
+
+    cur.execute("SELECT COUNT(*) FROM staging_events")
+    count = cur.fetchone()[0]
+    day = 0
+    while 0 < count < rows:
+        day = 2 * day + 1
+        cur.execute("""INSERT INTO staging_events (artist, auth, firstName, gender, itemInSession, lastName, length,
+            level, location, method, page, registration, sessionId, song, status, ts, userAgent, userId)
+            SELECT artist, auth, firstName, gender, itemInSession, lastName, length, level, location, method, page,
+                registration, sessionId, song, status, ts + %s, userAgent, userId
+            FROM staging_events""", (day * 86400000,))
+        count *= 2
+    conn.commit()
+    return count
+
+
+def explain_select(cur, query):
+    """
+    Description: This function can be used to run a SELECT with EXPLAIN (ANALYZE, BUFFERS)
+
+    Arguments:
+        cur: the cursor object.
+        query: SELECT statement.
+
+    Returns:
+        (seconds, bytes scanned)
+    """
+
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT COUNT(*) FROM ({}) AS q".format(query))
+    plan = cur.fetchone()[0][0]
+    return plan['Execution Time'] / 1000, plan_details(plan['Plan'])['bytes_scanned']
+
+
+def benchmark_start_time(cur, conn, config, rows, runs):
+    """
+    Description: This function can be used to compare the time and songplays selects on a large staging_events,
+    computing start_time from a VARCHAR ts cast to BIGINT on every row against the BIGINT ts of the COPY
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        config: dwh.cfg ConfigParser.
+        rows: number of staged events.
+        runs: number of runs of every select, the fastest is kept.
+
+    Returns:
+        None
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        load_increment(cur, conn, config, 1, seed=0)
+    rows = grow_staging_events(cur, conn, rows)
+
+    cur.execute("DROP TABLE IF EXISTS staging_events_varchar")
+    cur.execute("""CREATE TABLE staging_events_varchar AS
+        SELECT artist, auth, firstName, gender, itemInSession, lastName, length, level, location, method, page,
+            registration, sessionId, song, status, CAST(ts AS VARCHAR(50)) AS ts, userAgent, userId
+        FROM staging_events""")
+    cur.execute("ANALYZE staging_events_varchar")
+    conn.commit()
+
+    cur.execute("ANALYZE staging_events")
+    conn.commit()
+
+    print('{} staged events'.format(rows))
+    print('{:<10} {:>14} {:>14} {:>14} {:>14}'.format('select', 'VARCHAR ts', 'BIGINT ts', 'VARCHAR MB', 'BIGINT MB'))
+    saved = 0
+    for (table, varchar_query), (_, bigint_query) in zip(varchar_ts_selects, bigint_ts_selects):
+        varchar_runs = [explain_select(cur, varchar_query) for _ in range(runs)]
+        bigint_runs = [explain_select(cur, bigint_query) for _ in range(runs)]
+        varchar_seconds, bigint_seconds = min(varchar_runs)[0], min(bigint_runs)[0]
+        saved += varchar_seconds - bigint_seconds
+        print('{:<10} {:>12.2f} s {:>12.2f} s {:>14.1f} {:>14.1f}'.format(
+            table, varchar_seconds, bigint_seconds, varchar_runs[0][1] / 2 ** 20, bigint_runs[0][1] / 2 ** 20))
+    print('{:.2f} s saved by the selects'.format(saved))
+
+    cur.execute("DROP TABLE staging_events_varchar")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the upserts while the tables grow, on the local stand-ins')
+    parser.add_argument('--runs', type=int, default=10, help='number of increments loaded')
+    parser.add_argument('--scale', type=float, default=5, help='size of every increment relative to the sample')
+    parser.add_argument('--antijoin', action='store_true', help='time the NOT IN anti-join inserts instead')
+    parser.add_argument('--start-time', type=int, metavar='ROWS',
+                        help='compare the start_time of a VARCHAR and of a BIGINT ts on ROWS staged events')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = connect_local(config['LOCAL'])
+    cur = conn.cursor()
+
+    for query in drop_table_queries + create_table_queries:
+        cur.execute(query)
+    conn.commit()
+
+    if args.start_time:
+        benchmark_start_time(cur, conn, config, args.start_time, args.runs)
+        conn.close()
+        return
+
+    queries = antijoin_insert_queries if args.antijoin else insert_table_queries
+    print('{:>4} '.format('run') + ' '.join('{:>18}'.format(table) for table in TABLES))
+    for run in range(args.runs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_increment(cur, conn, config, args.scale, seed=run)
+        seconds = time_inserts(cur, conn, queries)
+
+        sizes = []
+        for table in TABLES:
+            cur.execute("SELECT COUNT(*) FROM {}".format(table))
+            sizes.append(cur.fetchone()[0])
+        print('{:>4} '.format(run) + ' '.join('{:>9} {:>6.2f} s'.format(size, s) for size, s in zip(sizes, seconds)))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
+import argparse
 import configparser
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
+from standins import connect_local
 
 """
 Using drop_table_queries to drop database tables, 
@@ -24,11 +26,20 @@ def create_tables(cur, conn):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Drop and create the Redshift tables')
+    parser.add_argument('--local', action='store_true',
+                        help='run against the local Postgres stand-in of the [LOCAL] section')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    print('Connecting to redshift')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    if args.local:
+        print('Connecting to the local stand-in')
+        conn = connect_local(config['LOCAL'])
+    else:
+        print('Connecting to redshift')
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
     cur = conn.cursor()
 
     drop_tables(cur, conn)
@@ -0,0 +1,106 @@
+import re
+import argparse
+import configparser
+from sql_queries import insert_table_queries, star_join_select
+from etl import connect
+
+"""
+Checks the physical design of dwh.cfg on the query plans: every join step of EXPLAIN
+is listed with its Redshift data movement, the ones moving rows between nodes are reported
+"""
+
+# data movement of a Redshift join step, from cheapest to most expensive
+COLOCATED = ('DS_DIST_NONE', 'DS_DIST_ALL_NONE')
+SHUFFLES = ('DS_DIST_INNER', 'DS_DIST_OUTER', 'DS_DIST_ALL_INNER', 'DS_BCAST_INNER', 'DS_DIST_BOTH')
+
+JOIN_PATTERN = re.compile(r'(Hash Join|Merge Join|Nested Loop|Hash (Left|Right|Full) Join)\s*(DS_\w+)?', re.I)
+CONDITION_PATTERN = re.compile(r'(Hash Cond|Merge Cond|Join Filter):\s*(.*)')
+
+
+def join_steps(plan):
+    """
+    Description: This function can be used to list the join steps of an EXPLAIN output
+
+    Arguments:
+        plan: lines of the EXPLAIN output.
+
+    Returns:
+        list of (join, data movement or None outside Redshift, join condition)
+    """
+
+    steps = []
+    for i, line in enumerate(plan):
+        match = JOIN_PATTERN.search(line)
+        if not match:
+            continue
+
+        condition = ''
+        for next_line in plan[i + 1:i + 4]:
+            found = CONDITION_PATTERN.search(next_line)
+            if found:
+                condition = found.group(2).strip()
+                break
+        steps.append((match.group(1), match.group(3), condition))
+    return steps
+
+
+def explain(cur, query):
+    cur.execute('EXPLAIN ' + query)
+    return [row[0] for row in cur.fetchall()]
+
+
+def check_plans(cur, conn):
+    """
+    Description: This function can be used to explain the upsert statements of every table and the star join.
+    Only the CREATE TEMP TABLE statements run, so the temp tables the DELETE, INSERT and MERGE read
+    exist while they are explained; these are explained without running, no table is written or locked.
+    The temp tables are dropped by the rollback at the end of every table.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+
+    Returns:
+        list of (statement, join, data movement, join condition) for every join step
+    """
+
+    steps = []
+    for queries in insert_table_queries:
+        for query in queries:
+            if query.startswith('DROP'):
+                continue
+            steps += [(query, *step) for step in join_steps(explain(cur, query))]
+            if query.startswith('CREATE TEMP TABLE'):
+                cur.execute(query)
+        conn.rollback()
+
+    steps += [(star_join_select, *step) for step in join_steps(explain(cur, star_join_select))]
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the joins moving rows between nodes')
+    parser.add_argument('--local', action='store_true',
+                        help='run against the local Postgres stand-in, which has no data movement to report')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn, _ = connect(config, args.local)
+    cur = conn.cursor()
+
+    shuffles = 0
+    for query, join, movement, condition in check_plans(cur, conn):
+        statement = ' '.join(query.split())[:60]
+        if movement in SHUFFLES:
+            shuffles += 1
+            print('SHUFFLE {:<16} {:<12} {:<50} {}'.format(movement, join, condition, statement))
+        else:
+            print('        {:<16} {:<12} {:<50} {}'.format(movement or 'n/a', join, condition, statement))
+
+    print('{} joins move rows between nodes, DS_BCAST_INNER and DS_DIST_BOTH are the most expensive'.format(shuffles))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,19 @@
+import time
+import argparse
 import configparser
+import concurrent.futures
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import psycopg2.pool
+from sql_queries import copy_table_queries, insert_table_queries, manifest_copy_queries
+from sql_queries import insert_table_names, insert_table_dependencies, staging_tables_truncate
+from sql_queries import insert_table_incremental_queries, insert_table_incremental_dependencies
+from staging import S3Storage, copy_sliced, new_objects, record_loaded_objects
+from profiling import StatementProfiler
+from standins import connect_local, RedshiftStandInConnection, RedshiftStandInCursor
+
+# per-table line of the sliced staging loads, commits is the time between the first and last file committed
+STAGING_REPORT = ('{table}: {objects} objects in {files} files on {slices} slices, {lines} lines, {bytes} bytes, '
+                  'manifest {manifest_seconds:.2f} s, COPY {copy_seconds:.2f} s, commits {commit_seconds:.2f} s')
 
 """
 the queries below to load data from S3 buckets
@@ -13,34 +26,193 @@ def load_staging_tables(cur, conn):
         conn.commit()
 
 """
-using INSERT statements to insert data from staging tables to 
-the dimension and fact tables that are created before
+the same staging loads with one COPY per table over a manifest of the input objects,
+or with REPACK of part files split so that every slice of the cluster loads the same amount of data
+"""
+def load_staging_tables_sliced(cur, conn, storage, staging):
+    for table, source, query in manifest_copy_queries:
+        print('Loading data : '+table)
+        stats = copy_sliced(cur, conn, storage, table, source, query,
+                            manifest_prefix=staging.get('MANIFEST_PREFIX').strip("'"),
+                            files_per_slice=staging.getint('FILES_PER_SLICE'),
+                            compress=staging.getboolean('GZIP'),
+                            repack=staging.getboolean('REPACK'))
+        print(STAGING_REPORT.format(**stats))
+
+"""
+incremental staging loads: the staging tables are emptied and only the objects
+not in loaded_files yet are copied, returns the (table, objects) loaded.
+The objects are recorded once the tables are upserted, so a failed run loads them again
 """
-def insert_tables(cur, conn):
-    for query in insert_table_queries:
-        print('Transform data: '+query)
+def load_staging_tables_incremental(cur, conn, storage, staging):
+    for query in staging_tables_truncate:
         cur.execute(query)
+    conn.commit()
+
+    loaded = []
+    for table, source, query in manifest_copy_queries:
+        objects = new_objects(cur, storage, table, source)
+        print('Loading data : {}, {} new objects'.format(table, len(objects)))
+        if not objects:
+            continue
+        stats = copy_sliced(cur, conn, storage, table, source, query,
+                            manifest_prefix=staging.get('MANIFEST_PREFIX').strip("'"),
+                            files_per_slice=staging.getint('FILES_PER_SLICE'),
+                            compress=staging.getboolean('GZIP'),
+                            repack=staging.getboolean('REPACK'),
+                            objects=objects)
+        print(STAGING_REPORT.format(**stats))
+        loaded.append((table, objects))
+    return loaded
+
+"""
+upserting the data from staging tables into 
+the dimension and fact tables that are created before,
+each table in one transaction
+"""
+def insert_tables(cur, conn, table_queries=insert_table_queries):
+    for queries in table_queries:
+        for query in queries:
+            print('Transform data: '+query)
+            cur.execute(query)
         conn.commit()
 
+"""
+upserting one table on a connection of the pool, in one transaction,
+with the time of every statement
+"""
+def insert_table(pool, table, queries, cursor_factory=None):
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor(cursor_factory=cursor_factory)
+        start = time.perf_counter()
+        for query in queries:
+            statement_start = time.perf_counter()
+            cur.execute(query)
+            print('{}: {:.2f} s {}'.format(table, time.perf_counter() - statement_start, ' '.join(query.split())[:80]))
+        conn.commit()
+        return time.perf_counter() - start
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+"""
+the same upserts with independent tables loaded at the same time on pooled connections,
+a table only waits for the tables it depends on (insert_table_dependencies, when foreign keys are enforced)
+"""
+def insert_tables_concurrent(pool, workers, enforced_foreign_keys=False, incremental=False, cursor_factory=None):
+    dependencies = {table: set(insert_table_dependencies.get(table, [])) if enforced_foreign_keys else set()
+                    for table in insert_table_names}
+    if incremental:
+        for table, tables in insert_table_incremental_dependencies.items():
+            dependencies[table].update(tables)
+    queries = dict(zip(insert_table_names, insert_table_incremental_queries if incremental else insert_table_queries))
+    done = set()
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        while len(done) < len(queries):
+            for table in queries:
+                if table not in done and table not in running.values() and dependencies[table] <= done:
+                    running[executor.submit(insert_table, pool, table, queries[table], cursor_factory)] = table
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)
+                # a failed table stops the run, the tables already loaded stay committed
+                print('{} loaded in {:.2f} s'.format(table, future.result()))
+                done.add(table)
+
+"""
+pool of connections to the cluster of dwh.cfg, or with local to the Postgres stand-in
+"""
+def connection_pool(config, local, size):
+    if local:
+        return psycopg2.pool.ThreadedConnectionPool(1, size, config.get('LOCAL', 'DSN'),
+                                                    connection_factory=RedshiftStandInConnection,
+                                                    cursor_factory=RedshiftStandInCursor)
+    return psycopg2.pool.ThreadedConnectionPool(1, size, "host={} dbname={} user={} password={} port={}".format(
+        *config['CLUSTER'].values()))
+
+"""
+connection to the cluster of dwh.cfg, or with local to the Postgres database
+and directory standing in for Redshift and S3
+"""
+def connect(config, local=False):
+    if local:
+        print('Connecting to the local stand-in: ')
+        conn = connect_local(config['LOCAL'])
+        return conn, conn.storage
+
+    print('Connecting to Redshift: ')
+    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    return conn, None
+
 def main():
+    parser = argparse.ArgumentParser(description='Load the S3 data into the Redshift star schema')
+    parser.add_argument('--sliced', action='store_true',
+                        help='stage the data with one COPY over a manifest of files split per slice')
+    parser.add_argument('--local', action='store_true',
+                        help='run against the local Postgres and S3 stand-ins of the [LOCAL] section')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='load independent tables at the same time on WORKERS pooled connections, see [UPSERT]')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only load the S3 objects not in loaded_files yet, with sliced staging loads')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='record the time, rows and query details of every statement in run_report and FILE (JSON)')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
   
-    print('Connecting to Redshift: ')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn, storage = connect(config, args.local)
 
-    print('Connected to Redshift')
-    cur = conn.cursor()
+    print('Connected')
+    cursor_factory = None
+    if args.profile:
+        profiler = StatementProfiler(args.local)
+        cursor_factory = profiler.cursor_class(conn.cursor_factory)
+    cur = conn.cursor(cursor_factory=cursor_factory)
     
     print('Loading staging tables: ')
-    load_staging_tables(cur, conn)
+    if args.incremental:
+        loaded = load_staging_tables_incremental(cur, conn, storage or S3Storage(), config['STAGING'])
+    elif args.sliced:
+        load_staging_tables_sliced(cur, conn, storage or S3Storage(), config['STAGING'])
+    else:
+        load_staging_tables(cur, conn)
     
     print('Transforming data from staging: ')
-    insert_tables(cur, conn)
+    if args.incremental and not loaded:
+        print('No new objects')
+    elif args.concurrent:
+        workers = config.getint('UPSERT', 'WORKERS')
+        pool = connection_pool(config, args.local, workers)
+        insert_tables_concurrent(pool, workers, config.get('UPSERT', 'FOREIGN_KEYS') == 'enforced', args.incremental,
+                                 cursor_factory)
+        pool.closeall()
+    elif args.incremental:
+        insert_tables(cur, conn, insert_table_incremental_queries)
+    else:
+        insert_tables(cur, conn)
+
+    if args.incremental:
+        for table, objects in loaded:
+            record_loaded_objects(cur, table, objects)
+        conn.commit()
+
+    if args.profile:
+        records = profiler.write_report(conn, args.profile)
+        print('Run {}: {} statements profiled in run_report and {}, the slowest:'.format(
+            profiler.run_id, len(records), args.profile))
+        for record in sorted(records, key=lambda record: -record['seconds'])[:5]:
+            print('{seconds:8.2f} s {row_count!s:>9} rows {statement:.80}'.format(**record))
 
     conn.close()
     print('ETL process ended, close the connection')
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
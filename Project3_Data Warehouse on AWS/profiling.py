@@ -0,0 +1,176 @@
+import re
+import json
+import time
+import datetime
+import itertools
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from sql_queries import run_report_table_create, run_report_insert, last_query_id_select, last_copy_id_select
+from sql_queries import query_bytes_select, slice_skew_select, load_errors_select, copy_rows_select
+
+"""
+Profiling of the SQL statements of an ETL run: every statement run on a profiling cursor is timed
+and described with the rows it affected and, on Redshift, its query id, the bytes its scans read, the skew
+of its rows across slices and the load errors of a COPY. On the Postgres stand-in the statements
+changing data are run with EXPLAIN ANALYZE instead. The run is written to the run_report table and a JSON file.
+"""
+
+# statements EXPLAIN ANALYZE can run, the rows of a SELECT are left for the caller to fetch
+EXPLAINABLE_PATTERN = re.compile(r'^\s*(INSERT|UPDATE|DELETE|MERGE|CREATE\s+(TEMP\s+|TEMPORARY\s+)?TABLE\s+\w+\s+AS)\b',
+                                 re.I)
+COPY_STATEMENT_PATTERN = re.compile(r'^\s*copy\b', re.I)
+
+REPORT_COLUMNS = ['run_id', 'statement_number', 'started_at', 'seconds', 'row_count', 'query_id', 'bytes_scanned',
+                  'slice_skew', 'load_errors', 'error', 'statement']
+
+# Postgres block size, the unit of the EXPLAIN BUFFERS counts
+BLOCK_SIZE = 8192
+
+
+def plan_details(plan):
+    """
+    Description: This function can be used to get the rows and bytes of a statement from its EXPLAIN (ANALYZE, BUFFERS) plan
+
+    Arguments:
+        plan: top node of the FORMAT JSON plan.
+
+    Returns:
+        dict with row_count and bytes_scanned
+    """
+
+    # an INSERT, UPDATE or DELETE node returns no rows, the node under it has the rows written
+    node = plan['Plans'][0] if plan['Node Type'] == 'ModifyTable' and plan.get('Plans') else plan
+    blocks = sum(plan.get(counter, 0) for counter in
+                 ['Shared Hit Blocks', 'Shared Read Blocks', 'Local Hit Blocks', 'Local Read Blocks'])
+    return {'row_count': node['Actual Rows'], 'bytes_scanned': blocks * BLOCK_SIZE}
+
+
+class StatementProfiler:
+    """
+    Description: Records every statement run on the cursors of cursor_class, against Redshift
+    or, with local, against the Postgres stand-in.
+    """
+
+    def __init__(self, local=False):
+        self.local = local
+        self.run_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.records = []
+        self.numbers = itertools.count(1)
+
+    def cursor_class(self, base=None):
+        """
+        Description: This function can be used to get a cursor class profiling the statements it executes
+
+        Arguments:
+            base: cursor class of the connection, the plain psycopg2 cursor when None.
+
+        Returns:
+            subclass of base to pass as cursor_factory
+        """
+
+        profiler = self
+
+        class ProfilingCursor(base or psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                return profiler.execute(self, super().execute, query, vars)
+
+        return ProfilingCursor
+
+    def execute(self, cur, execute, query, vars):
+        """
+        Description: This function can be used to run a statement and record its profile
+
+        Arguments:
+            cur: the profiling cursor.
+            execute: execute method of the cursor class it profiles.
+            query: statement.
+            vars: parameters of the statement.
+
+        Returns:
+            None
+        """
+
+        statement = query.decode(cur.connection.encoding) if isinstance(query, bytes) else query
+        record = dict.fromkeys(REPORT_COLUMNS)
+        record.update({'run_id': self.run_id, 'statement_number': next(self.numbers),
+                       'started_at': datetime.datetime.now(), 'statement': ' '.join(statement.split())[:4096]})
+
+        explain = self.local and EXPLAINABLE_PATTERN.match(statement)
+        start = time.perf_counter()
+        try:
+            if explain:
+                execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement, vars)
+            else:
+                execute(query, vars)
+        except Exception as error:
+            record.update({'seconds': time.perf_counter() - start, 'error': str(error).strip()[:1024]})
+            self.records.append(record)
+            raise
+        record['seconds'] = time.perf_counter() - start
+
+        if explain:
+            plan = cur.fetchone()[0]
+            record.update(plan_details((json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']))
+        else:
+            record['row_count'] = cur.rowcount
+            # another cursor of the same session, the rows of the statement stay on cur
+            record.update(self.query_details(cur.connection.cursor(), COPY_STATEMENT_PATTERN.match(statement)))
+        self.records.append(record)
+
+    def query_details(self, cur, copy):
+        """
+        Description: This function can be used to read the details of the last statement of the session from the system tables,
+        the stand-in only has the stl_load_commits of its COPY
+
+        Arguments:
+            cur: cursor of the session that ran the statement.
+            copy: the statement is a COPY.
+
+        Returns:
+            dict with the details found
+        """
+
+        details = {}
+        if not self.local:
+            # the query id is read first, the queries below are queries of the session too
+            cur.execute(last_copy_id_select if copy else last_query_id_select)
+            details['query_id'] = cur.fetchone()[0]
+        if copy:
+            cur.execute(copy_rows_select)
+            details['row_count'] = cur.fetchone()[0]
+        if self.local:
+            return details
+
+        query_id = details['query_id']
+        cur.execute(query_bytes_select, (query_id,))
+        details['bytes_scanned'] = cur.fetchone()[0]
+        cur.execute(slice_skew_select, (query_id,))
+        details['slice_skew'] = cur.fetchone()[0]
+        if copy:
+            cur.execute(load_errors_select, (query_id,))
+            details['load_errors'], details['error'] = cur.fetchone()
+        return details
+
+    def write_report(self, conn, path):
+        """
+        Description: This function can be used to add the records of the run to run_report and write them to a JSON file
+
+        Arguments:
+            conn: connection to the database, with no transaction in progress.
+            path: JSON file.
+
+        Returns:
+            records, in the order the statements started
+        """
+
+        records = sorted(self.records, key=lambda record: record['statement_number'])
+        cur = conn.cursor()
+        cur.execute(run_report_table_create)
+        if records:
+            execute_values(cur, run_report_insert, [[record[column] for column in REPORT_COLUMNS] for record in records],
+                           page_size=1000)
+        conn.commit()
+
+        with open(path, 'w') as f:
+            json.dump({'run_id': self.run_id, 'statements': records}, f, indent=2, default=str)
+        return records
@@ -5,15 +5,23 @@ import configparser
 config = configparser.ConfigParser()
 config.read('dwh.cfg')
 
+# the values are quoted in dwh.cfg, the queries below add their own quotes
+ARN = config.get('IAM_ROLE', 'ARN').strip("'")
+LOG_DATA = config.get('S3', 'LOG_DATA').strip("'")
+LOG_JSONPATH = config.get('S3', 'LOG_JSONPATH').strip("'")
+SONG_DATA = config.get('S3', 'SONG_DATA').strip("'")
+COPY_OPTIONS = config.get('STAGING', 'COPY_OPTIONS')
+
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
-songplay_table_drop = "DROP TABLE IF EXISTS songplay"
+songplay_table_drop = "DROP TABLE IF EXISTS songplays"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+loaded_files_table_drop = "DROP TABLE IF EXISTS loaded_files"
 
 # CREATE TABLES
 
@@ -34,9 +42,9 @@ staging_events_table_create= ("""CREATE TABLE staging_events(
     sessionId	BIGINT,
     song VARCHAR(255),
     status INTEGER,  
-    ts VARCHAR(50),
+    ts BIGINT,
     userAgent TEXT,	
-    userId VARCHAR(100)
+    userId VARCHAR(100))
 """)
 
 staging_songs_table_create = ("""CREATE TABLE staging_songs(
@@ -49,13 +57,13 @@ staging_songs_table_create = ("""CREATE TABLE staging_songs(
     artist_name VARCHAR(255),
     title VARCHAR(255),
     duration DOUBLE PRECISION,
-    year INTEGER
+    year INTEGER)
 """)
 
 songplay_table_create = ("""CREATE TABLE songplays(
     songplay_id INT IDENTITY(0,1),
     start_time TIMESTAMP REFERENCES time(start_time),
-    userId VARCHAR(50) REFERENCES users(user_id),
+    userId VARCHAR(50) REFERENCES users(userId),
     level VARCHAR(50),
     song_id VARCHAR(100) REFERENCES songs(song_id),
     artist_id VARCHAR(100) REFERENCES artists(artist_id),
@@ -71,7 +79,7 @@ user_table_create = ("""CREATE TABLE users(
     lastName VARCHAR(255),
     gender VARCHAR(1),
     level VARCHAR(50),
-    PRIMARY KEY (user_id))
+    PRIMARY KEY (userId))
 """)
 
 song_table_create = ("""CREATE TABLE songs(
@@ -103,104 +111,349 @@ time_table_create = ("""CREATE TABLE time(
     PRIMARY KEY (start_time))
 """)
 
+# S3 objects already loaded into a staging table, a new ETag or size under the same url is loaded again
+loaded_files_table_create = ("""CREATE TABLE loaded_files(
+    table_name VARCHAR(100),
+    url VARCHAR(1024),
+    size BIGINT,
+    etag VARCHAR(100),
+    loaded_at TIMESTAMP)
+""")
+
 # STAGING TABLES
 
 ### Load from JSON Arrays Using a JSONPaths file (LOG_JSONPATH),
-### to speed up the copying process by  using COMPUPDATE OFF and STATUPDATE OFF
+### to speed up the copying process by  using COMPUPDATE OFF and STATUPDATE OFF (COPY_OPTIONS in dwh.cfg)
 
 
 staging_events_copy = ("""copy staging_events from '{}'
  credentials 'aws_iam_role={}'
  region 'us-west-2' 
- COMPUPDATE OFF STATUPDATE OFF
- JSON '{}'""").format(config.get('S3','LOG_DATA'),
-                        config.get('IAM_ROLE', 'ARN'),
-                        config.get('S3','LOG_JSONPATH'))
+ {}
+ JSON '{}'""").format(LOG_DATA, ARN, COPY_OPTIONS, LOG_JSONPATH)
 
 
 staging_songs_copy = ("""copy staging_songs from '{}'
     credentials 'aws_iam_role={}'
     region 'us-west-2' 
-    COMPUPDATE OFF STATUPDATE OFF
+    {}
     JSON 'auto'
-    """).format(config.get('S3','SONG_DATA'), 
-                config.get('IAM_ROLE', 'ARN'))
+    """).format(SONG_DATA, ARN, COPY_OPTIONS)
+
+### Sliced loads: one COPY over a manifest listing part files written for every slice,
+### {manifest} and {compression} (GZIP or nothing) are filled in once the manifest is built
+
+staging_events_manifest_copy = ("""copy staging_events from '{{manifest}}'
+ credentials 'aws_iam_role={}'
+ region 'us-west-2'
+ MANIFEST {{compression}}
+ {}
+ JSON '{}'""").format(ARN, COPY_OPTIONS, LOG_JSONPATH)
+
+staging_songs_manifest_copy = ("""copy staging_songs from '{{manifest}}'
+ credentials 'aws_iam_role={}'
+ region 'us-west-2'
+ MANIFEST {{compression}}
+ {}
+ JSON 'auto'""").format(ARN, COPY_OPTIONS)
+
+# the staging tables are kept and emptied between increments
+staging_tables_truncate = ["TRUNCATE staging_events", "TRUNCATE staging_songs"]
+
+loaded_files_select = "SELECT url, size, etag FROM loaded_files WHERE table_name = %s"
+loaded_files_insert = "INSERT INTO loaded_files (table_name, url, size, etag, loaded_at) VALUES %s"
+
+# number of slices of the cluster, a manifest lists a multiple of it part files
+slice_count_select = "SELECT COUNT(*) FROM stv_slices"
+
+# files committed by the last COPY of the session, one row per file
+load_commits_select = ("""SELECT TRIM(filename), slice, lines_scanned, curtime
+    FROM stl_load_commits
+    WHERE query = pg_last_copy_id()
+    ORDER BY curtime
+""")
+
+
+# PROFILING
+
+# every statement of an ETL run profiled with etl.py --profile, kept across runs
+run_report_table_create = ("""CREATE TABLE IF NOT EXISTS run_report(
+    run_id VARCHAR(32),
+    statement_number INTEGER,
+    started_at TIMESTAMP,
+    seconds DOUBLE PRECISION,
+    row_count BIGINT,
+    query_id INTEGER,
+    bytes_scanned BIGINT,
+    slice_skew DOUBLE PRECISION,
+    load_errors INTEGER,
+    error VARCHAR(1024),
+    statement VARCHAR(4096))
+""")
+
+run_report_insert = ("""INSERT INTO run_report (run_id, statement_number, started_at, seconds, row_count, query_id,
+    bytes_scanned, slice_skew, load_errors, error, statement) VALUES %s""")
+
+# id of the last query of the session, to read before any other query; a COPY has its own id
+last_query_id_select = "SELECT pg_last_query_id()"
+last_copy_id_select = "SELECT pg_last_copy_id()"
+
+# bytes read by the scan steps of a query
+query_bytes_select = ("""SELECT SUM(bytes)
+    FROM svl_query_summary
+    WHERE query = %s AND label LIKE 'scan%%'
+""")
+
+# rows scanned by the busiest slice over the average slice, 1 when the data is evenly distributed
+slice_skew_select = ("""SELECT MAX(slice_rows) / NULLIF(AVG(slice_rows), 0)
+    FROM (SELECT slice, CAST(SUM(rows) AS DOUBLE PRECISION) AS slice_rows
+          FROM svl_query_report
+          WHERE query = %s AND label LIKE 'scan%%'
+          GROUP BY slice) AS slices
+""")
+
+load_errors_select = ("""SELECT COUNT(*), MIN(TRIM(err_reason))
+    FROM stl_load_errors
+    WHERE query = %s
+""")
+
+# lines loaded by the last COPY of the session
+copy_rows_select = "SELECT SUM(lines_scanned) FROM stl_load_commits WHERE query = pg_last_copy_id()"
 
 
 # FINAL TABLES
 
-songplay_table_insert = ("""INSERT INTO songplays (start_time, userId, level, song_id, artist_id, sessionId, location, userAgent) 
-    SELECT DISTINCT 
-        TIMESTAMP 'epoch' + ts/1000 *INTERVAL '1 second' as start_time, 
-        e.userId, 
-        e.level,
-        s.song_id,
-        s.artist_id,
-        e.sessionId,
-        e.location,
-        e.userAgent
-    FROM staging_events e, staging_songs s
-    WHERE e.page = 'NextSong'
-    AND e.song = s.title
-    AND e.length = e.duration
-    AND e.artist = s.artist_name
-    AND userId NOT IN (SELECT DISTINCT s.userId FROM songplays s WHERE s.userId = userId
-                       AND s.start_time = start_time AND s.sessionId = sessionId )
-""")
-
-user_table_insert = ("""NSERT INTO users (userId, firstName, lastName, gender, level)  
-    SELECT DISTINCT 
-        userId,
-        firstName,
-        lastName,
-        gender, 
-        level
-    FROM staging_events
-    WHERE page = 'NextSong'
-    AND userId NOT IN (SELECT DISTINCT userId FROM users)
-""")
-
-song_table_insert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration)                       
-    SELECT DISTINCT 
-        song_id, 
-        title,
-        artist_id,
-        year,
-        duration
-    FROM staging_songs
-    WHERE song_id NOT IN (SELECT DISTINCT song_id FROM songs)
-""")
-
-artist_table_insert = ("""INSERT INTO artists (artist_id, name, location, latitude, longitude) 
-    SELECT DISTINCT 
-        artist_id,
-        artist_name,
-        artist_location,
-        artist_latitude,
-        artist_longitude
-    FROM staging_songs
-    WHERE artist_id NOT IN (SELECT DISTINCT artist_id FROM artists)
-""")
-
-time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-    SELECT 
+### Staged upserts: the new rows of a table are selected once into a temp table, deduplicated on the natural key,
+### then merged into the table in one transaction, either with MERGE or with DELETE ... USING + INSERT (UPSERT MODE
+### in dwh.cfg). Both only join the table on its key, where NOT IN (SELECT DISTINCT ...) scanned the whole
+### table for every batch and slowed down as history accumulated.
+
+UPSERT_MODE = config.get('UPSERT', 'MODE')
+
+
+def upsert_queries(table, columns, keys, stage_select):
+    """
+    Description: This function can be used to build the statements upserting the rows of stage_select into table
+
+    Arguments:
+        table: target table.
+        columns: columns of stage_select, in the same order.
+        keys: natural key columns of the table.
+        stage_select: SELECT of the new rows, one row per key.
+
+    Returns:
+        list of statements to run in one transaction
+    """
+
+    stage = table + '_stage'
+    on = ' AND '.join('{0}.{1} = {2}.{1}'.format(table, key, stage) for key in keys)
+    values = ', '.join('{}.{}'.format(stage, column) for column in columns)
+
+    queries = ["CREATE TEMP TABLE {} AS {}".format(stage, stage_select)]
+    if UPSERT_MODE == 'merge':
+        updates = ', '.join('{0} = {1}.{0}'.format(column, stage) for column in columns if column not in keys)
+        queries.append("""MERGE INTO {} USING {} ON {}
+    WHEN MATCHED THEN UPDATE SET {}
+    WHEN NOT MATCHED THEN INSERT ({}) VALUES ({})""".format(table, stage, on, updates, ', '.join(columns), values))
+    else:
+        queries.append("DELETE FROM {} USING {} WHERE {}".format(table, stage, on))
+        queries.append("INSERT INTO {} ({}) SELECT {} FROM {}".format(table, ', '.join(columns), values, stage))
+    queries.append("DROP TABLE {}".format(stage))
+    return queries
+
+
+songplay_select = ("""SELECT start_time, userId, level, song_id, artist_id, sessionId, location, userAgent
+    FROM (
+        SELECT 
+            TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second' AS start_time, 
+            e.userId, 
+            e.level,
+            s.song_id,
+            s.artist_id,
+            e.sessionId,
+            e.location,
+            e.userAgent,
+            ROW_NUMBER() OVER (PARTITION BY e.ts/1000, e.userId, e.sessionId ORDER BY e.ts DESC, s.song_id) AS n
+        FROM staging_events e
+        JOIN {songs} s
+        ON e.song = s.title
+        AND e.length = s.duration
+        AND e.artist = s.artist_name
+        WHERE e.page = 'NextSong'
+    ) AS songplays_new
+    WHERE n = 1
+""")
+
+songplay_table_insert = upsert_queries('songplays',
+    ['start_time', 'userId', 'level', 'song_id', 'artist_id', 'sessionId', 'location', 'userAgent'],
+    ['start_time', 'userId', 'sessionId'],
+    songplay_select.format(songs='staging_songs'))
+
+# an increment only stages the new song files: its events are matched to every song loaded so far,
+# so this one reads the songs and artists tables once they are upserted
+songplay_table_incremental_insert = upsert_queries('songplays',
+    ['start_time', 'userId', 'level', 'song_id', 'artist_id', 'sessionId', 'location', 'userAgent'],
+    ['start_time', 'userId', 'sessionId'],
+    songplay_select.format(songs="""(SELECT songs.song_id, songs.artist_id, songs.title, songs.duration,
+            artists.name AS artist_name
+            FROM songs JOIN artists ON songs.artist_id = artists.artist_id)"""))
+
+user_table_insert = upsert_queries('users',
+    ['userId', 'firstName', 'lastName', 'gender', 'level'],
+    ['userId'],
+    """SELECT userId, firstName, lastName, gender, level
+    FROM (
+        SELECT 
+            userId,
+            firstName,
+            lastName,
+            gender, 
+            level,
+            ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS n
+        FROM staging_events
+        WHERE page = 'NextSong'
+    ) AS users_new
+    WHERE n = 1
+""")
+
+song_table_insert = upsert_queries('songs',
+    ['song_id', 'title', 'artist_id', 'year', 'duration'],
+    ['song_id'],
+    """SELECT song_id, title, artist_id, year, duration
+    FROM (
+        SELECT 
+            song_id, 
+            title,
+            artist_id,
+            year,
+            duration,
+            ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY title) AS n
+        FROM staging_songs
+    ) AS songs_new
+    WHERE n = 1
+""")
+
+artist_table_insert = upsert_queries('artists',
+    ['artist_id', 'name', 'location', 'latitude', 'longitude'],
+    ['artist_id'],
+    """SELECT artist_id, name, location, latitude, longitude
+    FROM (
+        SELECT 
+            artist_id,
+            artist_name AS name,
+            artist_location AS location,
+            artist_latitude AS latitude,
+            artist_longitude AS longitude,
+            ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS n
+        FROM staging_songs
+    ) AS artists_new
+    WHERE n = 1
+""")
+
+time_select = ("""SELECT 
         start_time, 
-        EXTRACT(hr from start_time) AS hour,
-        EXTRACT(d from start_time) AS day,
-        EXTRACT(w from start_time) AS week,
-        EXTRACT(mon from start_time) AS month,
-        EXTRACT(yr from start_time) AS year, 
-        EXTRACT(weekday from start_time) AS weekday 
+        EXTRACT(hour from start_time) AS hour,
+        EXTRACT(day from start_time) AS day,
+        EXTRACT(week from start_time) AS week,
+        EXTRACT(month from start_time) AS month,
+        EXTRACT(year from start_time) AS year, 
+        EXTRACT(dow from start_time) AS weekday 
     FROM (
-    	SELECT DISTINCT  TIMESTAMP 'epoch' + ts/1000 *INTERVAL '1 second' as start_time 
+    	SELECT DISTINCT TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 second' AS start_time
         FROM staging_events s     
-    )
-    WHERE start_time NOT IN (SELECT DISTINCT start_time FROM time)
+    ) AS time_new
+""")
+
+time_table_insert = upsert_queries('time',
+    ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'],
+    ['start_time'],
+    time_select)
+
+# ANALYTICS
+
+# songplays joined to every dimension, the join the physical design is made for
+star_join_select = ("""SELECT t.year, t.month, a.name, s.title, u.level, COUNT(*) AS plays
+    FROM songplays sp
+    JOIN songs s ON sp.song_id = s.song_id
+    JOIN artists a ON sp.artist_id = a.artist_id
+    JOIN users u ON sp.userId = u.userId
+    JOIN time t ON sp.start_time = t.start_time
+    GROUP BY t.year, t.month, a.name, s.title, u.level
 """)
 
+
+# PHYSICAL DESIGN
+
+### DISTSTYLE / DISTKEY and SORTKEY of every table from [DISTRIBUTION] and [SORT] in dwh.cfg.
+### songplays and songs share the song_id DISTKEY and users and artists are copied to every node (ALL),
+### so their star joins run without redistributing rows; time has about one row per event, it is distributed
+### on start_time instead of copied to every node. The staging tables share the artist name the songplays join uses.
+
+
+def table_design(table):
+    """
+    Description: This function can be used to get the distribution and sort clauses of a table from dwh.cfg
+
+    Arguments:
+        table: table name.
+
+    Returns:
+        clauses to append to the CREATE TABLE statement, empty when the table is not configured
+    """
+
+    clauses = []
+    distribution = config.get('DISTRIBUTION', table, fallback=None)
+    if distribution:
+        if distribution.upper() in ('ALL', 'EVEN', 'AUTO'):
+            clauses.append('DISTSTYLE {}'.format(distribution.upper()))
+        else:
+            clauses.append('DISTSTYLE KEY DISTKEY({})'.format(distribution))
+
+    sort = config.get('SORT', table, fallback=None)
+    if sort:
+        clauses.append('SORTKEY({})'.format(', '.join(column.strip() for column in sort.split(','))))
+
+    return ' '.join(clauses)
+
+
+def create_table_query(table, query):
+    """
+    Description: This function can be used to add the distribution and sort clauses of dwh.cfg to a CREATE TABLE statement
+
+    Arguments:
+        table: table name.
+        query: CREATE TABLE statement.
+
+    Returns:
+        CREATE TABLE statement with its physical design
+    """
+
+    return '{}\n{}\n'.format(query.rstrip(), table_design(table))
+
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [create_table_query(table, query) for table, query in [
+    ('staging_events', staging_events_table_create),
+    ('staging_songs', staging_songs_table_create),
+    ('users', user_table_create),
+    ('songs', song_table_create),
+    ('artists', artist_table_create),
+    ('time', time_table_create),
+    ('songplays', songplay_table_create),
+    ('loaded_files', loaded_files_table_create)]]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, loaded_files_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+manifest_copy_queries = [('staging_events', LOG_DATA, staging_events_manifest_copy),
+                         ('staging_songs', SONG_DATA, staging_songs_manifest_copy)]
+# every item is the list of statements of one table, run in one transaction
+insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
+insert_table_incremental_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert,
+                                    songplay_table_incremental_insert]
+insert_table_names = ['users', 'songs', 'artists', 'time', 'songplays']
+
+# tables a load must wait for: every upsert only reads the staging tables,
+# only with enforced foreign keys (FOREIGN_KEYS=enforced in [UPSERT]) songplays needs the rows it references
+insert_table_dependencies = {'songplays': ['users', 'songs', 'artists', 'time']}
+# the incremental songplays reads songs and artists, enforced foreign keys or not
+insert_table_incremental_dependencies = {'songplays': ['songs', 'artists']}
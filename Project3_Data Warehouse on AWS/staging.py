@@ -0,0 +1,249 @@
+import gzip
+import json
+import time
+import heapq
+import datetime
+import concurrent.futures
+from psycopg2.extras import execute_values
+from sql_queries import slice_count_select, load_commits_select, loaded_files_select, loaded_files_insert
+
+# objects read at the same time when they are repacked into part files
+READ_WORKERS = 32
+
+
+class S3Storage:
+    """
+    Description: Reads, writes and lists S3 objects by s3://bucket/key url, needs boto3.
+    """
+
+    def __init__(self):
+        # only needed against AWS, the local stand-in runs without it
+        import boto3
+        self.s3 = boto3.client('s3')
+
+    @staticmethod
+    def split(url):
+        bucket, _, key = url.replace('s3://', '', 1).partition('/')
+        return bucket, key
+
+    def list(self, url):
+        """
+        Description: This function can be used to list the objects whose key starts with the url
+
+        Arguments:
+            url: s3://bucket/prefix
+
+        Returns:
+            sorted list of (url, size, etag)
+        """
+
+        bucket, prefix = self.split(url)
+        objects = []
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                objects.append(('s3://{}/{}'.format(bucket, item['Key']), item['Size'], item['ETag'].strip('"')))
+        return sorted(objects)
+
+    def read(self, url):
+        bucket, key = self.split(url)
+        return self.s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def write(self, url, data):
+        bucket, key = self.split(url)
+        self.s3.put_object(Bucket=bucket, Key=key, Body=data)
+
+
+def get_slice_count(cur):
+    """
+    Description: This function can be used to get the number of slices of the cluster
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        number of slices
+    """
+
+    cur.execute(slice_count_select)
+    return cur.fetchone()[0]
+
+
+def write_manifest(storage, target, entries):
+    """
+    Description: This function can be used to write the manifest of a COPY
+
+    Arguments:
+        storage: S3Storage or the local stand-in.
+        target: s3://bucket/prefix of the manifest.
+        entries: manifest entries.
+
+    Returns:
+        manifest url
+    """
+
+    manifest = target + '.manifest'
+    storage.write(manifest, json.dumps({'entries': entries}, indent=2).encode())
+    return manifest
+
+
+def object_manifest(storage, objects, target):
+    """
+    Description: This function can be used to write the manifest listing the input objects themselves,
+    with their sizes from the listing: nothing is read, and the COPY spreads the objects over the slices
+
+    Arguments:
+        storage: S3Storage or the local stand-in.
+        objects: list of (url, size, etag) of the input objects.
+        target: s3://bucket/prefix the manifest is written to.
+
+    Returns:
+        (manifest url, manifest entries)
+    """
+
+    entries = [{'url': url, 'mandatory': True, 'meta': {'content_length': size}} for url, size, _ in objects]
+    return write_manifest(storage, target, entries), entries
+
+
+def build_manifest(storage, objects, target, num_files, compress=False):
+    """
+    Description: This function can be used to pack the input objects into num_files part files of about
+    the same size, so every slice of the cluster loads the same amount of data, and to write the manifest listing them.
+    Redshift loads one file per slice at a time: one big file or many tiny ones leave slices idle.
+    Every object is read through this host, READ_WORKERS at a time, and the part files are written back.
+
+    Arguments:
+        storage: S3Storage or the local stand-in.
+        objects: list of (url, size, etag) of the input objects.
+        target: s3://bucket/prefix the part files and the manifest are written to.
+        num_files: number of part files, a multiple of the number of slices.
+        compress: gzip the part files.
+
+    Returns:
+        (manifest url, manifest entries)
+    """
+
+    # largest objects first, each one into the smallest part so far
+    parts = [(0, i, []) for i in range(max(1, min(num_files, len(objects))))]
+    for url, size, _ in sorted(objects, key=lambda item: -item[1]):
+        part_size, i, urls = heapq.heappop(parts)
+        urls.append(url)
+        heapq.heappush(parts, (part_size + size, i, urls))
+
+    entries = []
+    with concurrent.futures.ThreadPoolExecutor(READ_WORKERS) as pool:
+        for _, i, urls in sorted(parts, key=lambda part: part[1]):
+            data = b''.join(body.rstrip() + b'\n' for body in pool.map(storage.read, urls))
+            if compress:
+                data = gzip.compress(data)
+            part_url = '{}/part-{:04d}.json{}'.format(target, i, '.gz' if compress else '')
+            storage.write(part_url, data)
+            entries.append({'url': part_url, 'mandatory': True, 'meta': {'content_length': len(data)}})
+
+    return write_manifest(storage, target, entries), entries
+
+
+def load_commit_stats(cur, entries):
+    """
+    Description: This function can be used to summarize the files committed by the last COPY from stl_load_commits
+
+    Arguments:
+        cur: the cursor object.
+        entries: manifest entries of the COPY, for the file sizes.
+
+    Returns:
+        dict with the files, lines, bytes and slices loaded, and the seconds between the first and last commit
+    """
+
+    sizes = {entry['url']: entry['meta']['content_length'] for entry in entries}
+    cur.execute(load_commits_select)
+    commits = cur.fetchall()
+
+    return {'files': len(commits),
+            'lines': sum(lines for _, _, lines, _ in commits),
+            'bytes': sum(sizes.get(filename, 0) for filename, _, _, _ in commits),
+            'slices': len(set(slice for _, slice, _, _ in commits)),
+            'commit_seconds': (commits[-1][3] - commits[0][3]).total_seconds() if commits else 0}
+
+
+def copy_sliced(cur, conn, storage, table, source, copy_query, manifest_prefix, files_per_slice=1, compress=True,
+                objects=None, repack=False):
+    """
+    Description: This function can be used to load a staging table with one COPY over a manifest
+    of the input objects or, with repack, of part files split for every slice of the cluster
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        storage: S3Storage or the local stand-in.
+        table: staging table.
+        source: s3://bucket/prefix of the input objects.
+        copy_query: COPY statement with {manifest} and {compression} to fill in.
+        manifest_prefix: s3://bucket/prefix the part files and manifests are written to.
+        files_per_slice: number of part files per slice, with repack.
+        compress: gzip the part files, with repack.
+        objects: list of (url, size, etag) to load, every object under source when None.
+        repack: pack the objects into part files first, see build_manifest.
+
+    Returns:
+        dict with the table, files, lines, bytes and slices loaded and the COPY and manifest seconds
+    """
+
+    if objects is None:
+        objects = storage.list(source)
+
+    start = time.perf_counter()
+    target = '{}/{}'.format(manifest_prefix, table)
+    compress = compress and repack
+    if repack:
+        manifest, entries = build_manifest(storage, objects, target, get_slice_count(cur) * files_per_slice, compress)
+    else:
+        manifest, entries = object_manifest(storage, objects, target)
+    manifest_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cur.execute(copy_query.format(manifest=manifest, compression='GZIP' if compress else ''))
+    conn.commit()
+    copy_seconds = time.perf_counter() - start
+
+    stats = {'table': table, 'objects': len(objects), 'manifest_seconds': manifest_seconds, 'copy_seconds': copy_seconds}
+    stats.update(load_commit_stats(cur, entries))
+    return stats
+
+
+def new_objects(cur, storage, table, source):
+    """
+    Description: This function can be used to list the objects under source not loaded into table yet,
+    an object counts as loaded when loaded_files has its url with the same size and ETag
+
+    Arguments:
+        cur: the cursor object.
+        storage: S3Storage or the local stand-in.
+        table: staging table.
+        source: s3://bucket/prefix of the input objects.
+
+    Returns:
+        list of (url, size, etag) of the new or changed objects
+    """
+
+    cur.execute(loaded_files_select, (table,))
+    loaded = set(cur.fetchall())
+    return [item for item in storage.list(source) if item not in loaded]
+
+
+def record_loaded_objects(cur, table, objects):
+    """
+    Description: This function can be used to add the objects loaded into table to loaded_files,
+    in the caller's transaction
+
+    Arguments:
+        cur: the cursor object.
+        table: staging table.
+        objects: list of (url, size, etag).
+
+    Returns:
+        None
+    """
+
+    loaded_at = datetime.datetime.now()
+    rows = [(table, url, size, etag, loaded_at) for url, size, etag in objects]
+    execute_values(cur, loaded_files_insert, rows, page_size=1000)
@@ -0,0 +1,298 @@
+import io
+import os
+import re
+import csv
+import sys
+import glob
+import gzip
+import json
+import shutil
+import hashlib
+import configparser
+import psycopg2
+import psycopg2.extensions
+
+"""
+Local stand-ins for S3 and Redshift, so the staging and loading code can run
+without AWS: s3://bucket/key is the file S3_ROOT/bucket/key, and a Postgres
+database emulates the Redshift COPY and the system tables the ETL reads
+"""
+
+
+class LocalStorage:
+    """
+    Description: S3 stand-in keeping the object s3://bucket/key in the file root/bucket/key,
+    with the same methods as staging.S3Storage.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, url):
+        return os.path.join(self.root, url.replace('s3://', '', 1))
+
+    def list(self, url):
+        """
+        Description: This function can be used to list the objects whose key starts with the url, like an S3 prefix
+
+        Arguments:
+            url: s3://bucket/prefix
+
+        Returns:
+            sorted list of (url, size, etag), the etag being the md5 of the object like for a single part upload
+        """
+
+        objects = []
+        for path in glob.glob(self.path(url) + '*') + glob.glob(os.path.join(self.path(url) + '*', '**'), recursive=True):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    etag = hashlib.md5(f.read()).hexdigest()
+                objects.append(('s3://' + os.path.relpath(path, self.root), os.path.getsize(path), etag))
+        return sorted(set(objects))
+
+    def read(self, url):
+        with open(self.path(url), 'rb') as f:
+            return f.read()
+
+    def write(self, url, data):
+        os.makedirs(os.path.dirname(self.path(url)), exist_ok=True)
+        with open(self.path(url), 'wb') as f:
+            f.write(data)
+
+
+# Redshift-only syntax and the Postgres statement doing the same
+REDSHIFT_SYNTAX = [
+    (re.compile(r'IDENTITY\((\d+),\s*(\d+)\)', re.I),
+     r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 MINVALUE \1 INCREMENT BY \2)'),
+    # Redshift does not enforce foreign keys
+    (re.compile(r'\s+REFERENCES\s+\w+\s*\(\w+\)', re.I), ''),
+    # Postgres has no distribution, and a table's order is its indexes'
+    (re.compile(r'\s*\bDISTSTYLE\s+\w+', re.I), ''),
+    (re.compile(r'\s*\b(DISTKEY|(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY)\s*\([^)]*\)', re.I), ''),
+]
+
+COPY_PATTERN = re.compile(r"^\s*copy\s+(\w+)\s*(?:\(([^)]*)\))?\s+from\s+'([^']+)'(.*)$", re.I | re.S)
+JSON_PATTERN = re.compile(r"JSON\s+'([^']+)'", re.I)
+
+system_tables_create = ["""CREATE TABLE IF NOT EXISTS stl_load_commits(
+    userid INTEGER,
+    query INTEGER,
+    slice INTEGER,
+    name CHAR(256),
+    filename CHAR(256),
+    byte_offset INTEGER,
+    lines_scanned INTEGER,
+    errors INTEGER,
+    status INTEGER,
+    curtime TIMESTAMP,
+    file_format CHAR(16))
+""", "CREATE INDEX IF NOT EXISTS stl_load_commits_query ON stl_load_commits (query)",
+    "CREATE SEQUENCE IF NOT EXISTS stl_query_seq",
+    # the last COPY of the session like on Redshift, kept in a setting so it is read once and not per row
+    """CREATE OR REPLACE FUNCTION pg_last_copy_id() RETURNS INTEGER
+    AS 'SELECT CAST(NULLIF(current_setting(''standin.last_copy_id'', true), '''') AS INTEGER)' LANGUAGE sql STABLE""",
+    "CREATE TABLE IF NOT EXISTS stv_slices(node INTEGER, slice INTEGER)",
+    "TRUNCATE stv_slices"]
+
+
+def translate(query):
+    """
+    Description: This function can be used to rewrite the Redshift-only syntax of a statement for Postgres
+
+    Arguments:
+        query: Redshift statement.
+
+    Returns:
+        Postgres statement
+    """
+
+    for pattern, replacement in REDSHIFT_SYNTAX:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def json_records(data):
+    """
+    Description: This function can be used to parse JSON objects written one after the other,
+    with or without newlines between them, as Redshift COPY JSON reads them
+
+    Arguments:
+        data: text of the file.
+
+    Returns:
+        generator of dicts
+    """
+
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        while position < len(data) and data[position].isspace():
+            position += 1
+        if position == len(data):
+            return
+        record, position = decoder.raw_decode(data, position)
+        yield record
+
+
+def jsonpath_key(path):
+    """
+    Description: This function can be used to get the key of a JSONPaths expression, $['artist'] or $.artist
+    """
+
+    match = re.match(r"^\$(?:\['([^']+)'\]|\.(\w+))$", path)
+    return match.group(1) or match.group(2)
+
+
+class RedshiftStandInConnection(psycopg2.extensions.connection):
+    """
+    Description: Postgres connection standing in for Redshift, its cursors translate Redshift syntax
+    and emulate COPY from S3 (storage) into slices (number of slices recorded in stl_load_commits).
+    """
+
+    storage = None
+    slices = 1
+
+
+class RedshiftStandInCursor(psycopg2.extensions.cursor):
+    """
+    Description: Cursor of a RedshiftStandInConnection.
+    """
+
+    def execute(self, query, vars=None):
+        # psycopg2.extras.execute_values sends the statement already encoded
+        if isinstance(query, bytes):
+            query = query.decode(self.connection.encoding)
+        match = COPY_PATTERN.match(query)
+        if match:
+            return self.copy_from_s3(match.group(1), match.group(3), match.group(4), match.group(2))
+        return super().execute(translate(query), vars)
+
+    def copy_from_s3(self, table, url, options, column_list=None):
+        """
+        Description: This function can be used to emulate a Redshift COPY ... JSON from an S3 prefix or a manifest.
+        The records of every file are loaded with a Postgres COPY and every file is recorded in stl_load_commits
+        on the slice a Redshift cluster would give it.
+
+        Arguments:
+            table: staging table.
+            url: S3 prefix, or manifest with the MANIFEST option.
+            options: rest of the COPY statement (MANIFEST, GZIP, JSON 'auto' or JSON 'jsonpaths file').
+            column_list: columns listed after the table, every column but the IDENTITY ones when None.
+
+        Returns:
+            None
+        """
+
+        storage = self.connection.storage
+        upper = options.upper()
+        if re.search(r'\bMANIFEST\b', upper):
+            urls = [entry['url'] for entry in json.loads(storage.read(url))['entries']]
+        else:
+            urls = [object_url for object_url, _, _ in storage.list(url)]
+
+        if column_list:
+            columns = [column.strip().lower() for column in column_list.split(',')]
+        else:
+            # Redshift leaves IDENTITY columns out of a COPY without column list
+            super().execute("""SELECT column_name FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = %s AND is_identity = 'NO'
+                ORDER BY ordinal_position""", (table,))
+            columns = [row[0] for row in self.fetchall()]
+
+        jsonpaths = JSON_PATTERN.search(options).group(1)
+        if jsonpaths.lower() == 'auto':
+            keys = None
+        else:
+            keys = [jsonpath_key(path) for path in json.loads(storage.read(jsonpaths))['jsonpaths']]
+
+        super().execute("SELECT nextval('stl_query_seq')")
+        query_id = self.fetchone()[0]
+        super().execute("SELECT set_config('standin.last_copy_id', %s, false)", (str(query_id),))
+
+        for i, file_url in enumerate(urls):
+            data = storage.read(file_url)
+            if re.search(r'\bGZIP\b', upper):
+                data = gzip.decompress(data)
+
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            lines = 0
+            for record in json_records(data.decode('utf8')):
+                if keys is None:
+                    record = {key.lower(): value for key, value in record.items()}
+                    values = [record.get(column) for column in columns]
+                else:
+                    values = [record.get(key) for key in keys]
+                writer.writerow(['\\N' if value is None else value for value in values])
+                lines += 1
+            buffer.seek(0)
+
+            self.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table, ', '.join(columns)),
+                             buffer)
+            super().execute("""INSERT INTO stl_load_commits (userid, query, slice, name, filename, byte_offset,
+                lines_scanned, errors, status, curtime, file_format)
+                VALUES (1, %s, %s, %s, %s, 0, %s, 0, 1, clock_timestamp(), 'Json')""",
+                            (query_id, i % self.connection.slices, table, file_url, lines))
+
+
+def connect_local(local):
+    """
+    Description: This function can be used to connect to the Postgres database standing in for Redshift,
+    creating the emulated system tables
+
+    Arguments:
+        local: [LOCAL] section of dwh.cfg, with DSN, S3_ROOT and SLICES.
+
+    Returns:
+        RedshiftStandInConnection
+    """
+
+    conn = psycopg2.connect(local['DSN'], connection_factory=RedshiftStandInConnection,
+                            cursor_factory=RedshiftStandInCursor)
+    conn.storage = LocalStorage(local['S3_ROOT'])
+    conn.slices = int(local['SLICES'])
+
+    cur = conn.cursor()
+    for query in system_tables_create:
+        cur.execute(query)
+    cur.executemany("INSERT INTO stv_slices VALUES (0, %s)", [(i,) for i in range(conn.slices)])
+    conn.commit()
+    return conn
+
+
+def seed_local_storage(config, data):
+    """
+    Description: This function can be used to copy song_data and log_data (from Project1 or generate_data.py)
+    to the S3 stand-in under the LOG_DATA and SONG_DATA urls of dwh.cfg, with a JSONPaths file at LOG_JSONPATH
+
+    Arguments:
+        config: dwh.cfg ConfigParser.
+        data: directory holding the song_data and log_data folders.
+
+    Returns:
+        None
+    """
+
+    storage = LocalStorage(config.get('LOCAL', 'S3_ROOT'))
+    for folder, option in [('log_data', 'LOG_DATA'), ('song_data', 'SONG_DATA')]:
+        target = storage.path(config.get('S3', option).strip("'"))
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(os.path.join(data, folder), target)
+
+    columns = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+               'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+    jsonpaths = {'jsonpaths': ["$['{}']".format(column) for column in columns]}
+    storage.write(config.get('S3', 'LOG_JSONPATH').strip("'"), json.dumps(jsonpaths, indent=2).encode())
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    data = sys.argv[1] if len(sys.argv) > 1 else '../Project1_Data_Modeling_with_Postgres/data'
+    seed_local_storage(config, data)
+    print('{} copied to {}'.format(data, config.get('LOCAL', 'S3_ROOT')))
+
+
+if __name__ == "__main__":
+    main()
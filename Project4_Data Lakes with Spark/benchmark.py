@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import urllib.request
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, monotonically_increasing_id, to_timestamp, date_format, countDistinct
+from pyspark.sql.functions import sum as spark_sum
+from pyspark.sql.types import TimestampType
+from etl import config, logdata_schema, read_song_data, song_dimension, join_songs
+
+sys.path.append('../Project1_Data_Modeling_with_Postgres')
+from generate_data import generate
+
+"""
+Benchmarks of the Project4 stages on generated data with a local Spark, reading the shuffle and input
+metrics of every variant from the REST API of the Spark UI
+"""
+
+
+def create_local_spark_session():
+    # only the explicit broadcast() hints broadcast, so every variant runs the join it asks for
+    return SparkSession \
+        .builder \
+        .master("local[*]") \
+        .config("spark.sql.autoBroadcastJoinThreshold", -1) \
+        .config("spark.sql.legacy.timeParserPolicy", "LEGACY") \
+        .getOrCreate()
+
+
+def generate_input(output, scale, skew):
+    """
+        Song and log data of generate_data.py in the song-data and log-data folders etl.py reads
+    """
+    generate(output, scale, skew=skew)
+    os.rename(os.path.join(output, 'song_data'), os.path.join(output, 'song-data'))
+    os.rename(os.path.join(output, 'log_data'), os.path.join(output, 'log-data'))
+    return output + '/'
+
+
+def stage_metrics(spark, group):
+    """
+        Input and shuffle bytes, task time and tasks of the stages run by the jobs of a job group,
+        from the Spark UI REST API once every job of the group has ended
+    """
+    url = '{}/api/v1/applications/{}'.format(spark.sparkContext.uiWebUrl, spark.sparkContext.applicationId)
+    for _ in range(50):
+        jobs = [job for job in json.load(urllib.request.urlopen(url + '/jobs')) if job.get('jobGroup') == group]
+        if jobs and all(job['status'] != 'RUNNING' for job in jobs):
+            break
+        time.sleep(0.1)
+
+    stage_ids = set(stage_id for job in jobs for stage_id in job['stageIds'])
+    stages = [stage for stage in json.load(urllib.request.urlopen(url + '/stages')) if stage['stageId'] in stage_ids]
+    return {'input_bytes': sum(stage['inputBytes'] for stage in stages),
+            'shuffle_read_bytes': sum(stage['shuffleReadBytes'] for stage in stages),
+            'shuffle_write_bytes': sum(stage['shuffleWriteBytes'] for stage in stages),
+            'task_seconds': sum(stage['executorRunTime'] for stage in stages) / 1000,
+            'tasks': sum(stage['numTasks'] for stage in stages if stage['status'] != 'SKIPPED')}
+
+
+def run_group(spark, group, action):
+    """
+        Runs action in its own job group, returns its result, seconds and stage_metrics
+    """
+    spark.sparkContext.setJobGroup(group, group)
+    start = time.perf_counter()
+    result = action()
+    seconds = time.perf_counter() - start
+    return result, seconds, stage_metrics(spark, group)
+
+
+def artist_join_songplays(df, song_df):
+    """
+        The songplays join before the song dimension, kept as the baseline: every event is joined
+        to every song of its artist
+    """
+    return song_df.join(df, song_df.artist_name == df.artist). \
+        withColumn("songplay_id", monotonically_increasing_id())
+
+
+def benchmark_joins(spark, input_data, salt_buckets):
+    song_df = read_song_data(spark, input_data)
+    df = spark.read.json(input_data + 'log-data/*/*/*.json', schema=logdata_schema). \
+        filter(col("page") == 'NextSong').cache()
+    print('{} events, {} songs'.format(df.count(), song_df.count()))
+
+    variants = [('artist join', lambda: artist_join_songplays(df, song_df)),
+                ('broadcast', lambda: join_songs(df, song_dimension(song_df), True)),
+                ('salted x{}'.format(salt_buckets), lambda: join_songs(df, song_dimension(song_df), False, salt_buckets))]
+
+    print('{:<14} {:>10} {:>9} {:>14} {:>14} {:>9} {:>7}'.format(
+        'join', 'rows', 'seconds', 'shuffle read', 'shuffle write', 'task s', 'tasks'))
+    for name, build in variants:
+        rows, seconds, metrics = run_group(spark, name, lambda: build().count())
+        print('{:<14} {:>10} {:>9.2f} {:>14} {:>14} {:>9.2f} {:>7}'.format(
+            name, rows, seconds, metrics['shuffle_read_bytes'], metrics['shuffle_write_bytes'],
+            metrics['task_seconds'], metrics['tasks']))
+
+
+def benchmark_timestamps(spark, input_data, repeat):
+    """
+        The ts to timestamp conversion etl.py made before, formatting to a string and parsing it back,
+        against the numeric cast of etl.py, on the generated events repeated repeat times (shifted by
+        a millisecond each). The rows where they disagree come from the MM (month) of the old pattern
+        standing where the minutes (mm) belong.
+    """
+    timestampFormat = "yyyy-MM-dd HH:MM:ss z"
+    events = spark.read.json(input_data + 'log-data/*/*/*.json', schema=logdata_schema). \
+        select("ts").crossJoin(spark.range(repeat)). \
+        select((col("ts") + col("id")).alias("ts")).cache()
+    print('{} events'.format(events.count()))
+
+    variants = [('string round-trip', to_timestamp(date_format((col("ts") / 1000).cast(TimestampType()), timestampFormat),
+                                                   timestampFormat)),
+                ('numeric cast', (col("ts") / 1000).cast(TimestampType()))]
+    print('{:<18} {:>9} {:>9} {:>16}'.format('conversion', 'seconds', 'task s', 'distinct values'))
+    for name, expression in variants:
+        distinct, seconds, metrics = run_group(spark, name, lambda: events.select(
+            countDistinct(expression.cast("long"))).first()[0])
+        print('{:<18} {:>9.2f} {:>9.2f} {:>16}'.format(name, seconds, metrics['task_seconds'], distinct))
+
+    wrong = events.select(spark_sum((variants[0][1].cast("long") != variants[1][1].cast("long")).cast("int"))).first()[0]
+    print('{} of {} timestamps differ between the conversions'.format(wrong, events.count()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Project4 stages on generated data with a local Spark')
+    parser.add_argument('--scale', type=float, default=1, help='size of the data relative to the Project1 sample')
+    parser.add_argument('--skew', type=float, default=1.1, help='zipf skew of the song plays, higher for hotter songs')
+    parser.add_argument('--salt-buckets', type=int, default=config.getint('ETL', 'SALT_BUCKETS'))
+    parser.add_argument('--timestamps', type=int, metavar='REPEAT',
+                        help='time the ts conversions on the events repeated REPEAT times instead of the joins')
+    args = parser.parse_args()
+
+    spark = create_local_spark_session()
+    with tempfile.TemporaryDirectory() as data:
+        input_data = generate_input(data, args.scale, args.skew)
+        if args.timestamps:
+            benchmark_timestamps(spark, input_data, args.timestamps)
+        else:
+            benchmark_joins(spark, input_data, args.salt_buckets)
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import argparse
+from math import ceil
+from statistics import median
+from etl import config, create_spark_session
+
+"""
+File-count and size report of the parquet tables, and compaction of the partitions
+written as more small files than their size needs
+"""
+
+TABLES = ['songs', 'artists', 'users', 'time', 'songplays']
+
+# directory of a partition the compacted files are written to, and the text files under it listing the files they replace
+STAGING = '_compacting'
+REPLACED = '_replaced'
+
+# upper bounds of the file size buckets of the report
+SIZE_BUCKETS = [(2 ** 20, '<1MB'), (16 * 2 ** 20, '1-16MB'), (64 * 2 ** 20, '16-64MB'), (128 * 2 ** 20, '64-128MB'),
+                (None, '>128MB')]
+
+
+def hadoop_path(spark, path):
+    """
+        Hadoop FileSystem and Path of a path, s3a:// or local
+    """
+    jpath = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return jpath.getFileSystem(spark._jsc.hadoopConfiguration()), jpath
+
+
+def list_partitions(spark, path):
+    """
+        Data files of a table by partition directory: {directory: [(file, size)]},
+        the _SUCCESS, .crc and _ directories (compactions in progress) left out
+    """
+    fs, root = hadoop_path(spark, path)
+    root_name = fs.makeQualified(root).toString()
+    partitions = {}
+    files = fs.listFiles(root, True)
+    while files.hasNext():
+        status = files.next()
+        file_path = status.getPath().toString()
+        relative = file_path[len(root_name):]
+        if any(part.startswith('_') or part.startswith('.') for part in relative.split('/')):
+            continue
+        partitions.setdefault(status.getPath().getParent().toString(), []).append((file_path, status.getLen()))
+    return partitions
+
+
+def leftover_compactions(spark, path):
+    """
+        The _compacting directories of a table holding files, left by compactions that were stopped
+    """
+    fs, root = hadoop_path(spark, path)
+    marker = '/' + STAGING + '/'
+    stagings = set()
+    files = fs.listFiles(root, True)
+    while files.hasNext():
+        file_path = files.next().getPath().toString()
+        if marker in file_path:
+            stagings.add(file_path[:file_path.index(marker) + len(marker) - 1])
+    return sorted(stagings)
+
+
+def size_bucket(size):
+    for bound, name in SIZE_BUCKETS:
+        if bound is None or size < bound:
+            return name
+
+
+def file_report(spark, path, target_bytes):
+    """
+        Prints the partitions, files and bytes of a table, the median file size, the files
+        under a quarter of target_bytes and the number of files of every size bucket
+    """
+    partitions = list_partitions(spark, path)
+    sizes = [size for files in partitions.values() for _, size in files]
+    if not sizes:
+        print('{}: no files'.format(path))
+        return
+
+    buckets = {name: 0 for _, name in SIZE_BUCKETS}
+    for size in sizes:
+        buckets[size_bucket(size)] += 1
+    print('{}: {} partitions, {} files, {:.1f} MB, median file {:.2f} MB, {} files under {:.0f} MB'.format(
+        path, len(partitions), len(sizes), sum(sizes) / 2 ** 20, median(sizes) / 2 ** 20,
+        sum(1 for size in sizes if size < target_bytes / 4), target_bytes / 4 / 2 ** 20))
+    print('    ' + '  '.join('{} {}'.format(name, count) for name, count in buckets.items()))
+    leftover = leftover_compactions(spark, path)
+    if leftover:
+        print('    {} stopped compactions, --compact finishes them'.format(len(leftover)))
+
+
+def finish_compaction(spark, staging):
+    """
+        Moves the files of a _compacting directory into its partition, as compacted-<name> so they cannot take the
+        name of a file they replace, then deletes the files listed in _replaced and the directory. The old files
+        are only deleted once every new file is in the partition. A directory with no complete _replaced list
+        is from a compaction stopped while writing, the partition is untouched and it is deleted.
+        Returns whether the compaction was finished
+    """
+    fs, jstaging = hadoop_path(spark, staging)
+    Path = spark._jvm.org.apache.hadoop.fs.Path
+    directory = jstaging.getParent().toString()
+    if not fs.exists(Path(staging + '/' + REPLACED + '/_SUCCESS')):
+        fs.delete(jstaging, True)
+        return False
+
+    replaced = [row.value for row in spark.read.text(staging + '/' + REPLACED).collect()]
+    for status in fs.listStatus(jstaging):
+        name = status.getPath().getName()
+        if not name.startswith('_') and not name.startswith('.'):
+            fs.rename(status.getPath(), Path(directory + '/compacted-' + name))
+    for file_path in replaced:
+        fs.delete(Path(file_path), False)
+    fs.delete(jstaging, True)
+    return True
+
+
+def compact_partition(spark, directory, files, target_bytes):
+    """
+        Rewrites the files of a partition directory as ceil(bytes / target_bytes) files: the new files are
+        written to a _compacting directory Spark readers skip with the list of the files they replace,
+        then finish_compaction moves them in before deleting the old ones
+    """
+    staging = directory + '/' + STAGING
+    num_files = max(1, int(ceil(sum(size for _, size in files) / float(target_bytes))))
+
+    # the partition columns are in the directory names, the files only hold the other columns
+    spark.read.parquet(*[file_path for file_path, _ in files]).repartition(num_files). \
+        write.mode('overwrite').parquet(staging)
+    # written last, its _SUCCESS marks the new files complete
+    spark.createDataFrame([(file_path,) for file_path, _ in files], ['value']).coalesce(1). \
+        write.text(staging + '/' + REPLACED)
+
+    finish_compaction(spark, staging)
+    return num_files
+
+
+def compact_table(spark, path, target_bytes):
+    """
+        Finishes the compactions of a table left by a stopped run, then compacts the partitions
+        holding more files than their size needs
+    """
+    for staging in leftover_compactions(spark, path):
+        print('{}: {}'.format(staging, 'finished' if finish_compaction(spark, staging) else 'discarded'))
+
+    compacted = 0
+    for directory, files in sorted(list_partitions(spark, path).items()):
+        needed = max(1, int(ceil(sum(size for _, size in files) / float(target_bytes))))
+        if len(files) > needed:
+            compact_partition(spark, directory, files, target_bytes)
+            compacted += 1
+    print('{}: {} partitions compacted'.format(path, compacted))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report and compact the parquet files of the data lake tables')
+    parser.add_argument('tables', nargs='*', default=TABLES, help='tables to report on or compact, all by default')
+    parser.add_argument('--compact', action='store_true', help='rewrite the partitions with too many small files')
+    parser.add_argument('--output', default='s3a://udacity-dend/', help='folder of the tables')
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    target_bytes = config.getint('ETL', 'TARGET_FILE_MB') * 2 ** 20
+    for table in args.tables:
+        if args.compact:
+            compact_table(spark, args.output + table, target_bytes)
+        file_report(spark, args.output + table, target_bytes)
+
+
+if __name__ == "__main__":
+    main()
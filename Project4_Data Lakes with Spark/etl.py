@@ -1,53 +1,123 @@
 # import packages
 import configparser
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import argparse
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, to_timestamp, monotonically_increasing_id
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
+from pyspark.sql.functions import udf, col, broadcast, md5, concat_ws, row_number
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear
+from pyspark.sql.functions import explode, array, lit, pmod, hash as spark_hash
+from pyspark.sql.functions import ceil, sum as spark_sum
+from pyspark.sql.window import Window
 from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType, TimestampType
 
 config = configparser.ConfigParser()
 config.read('dl.cfg')
 
-os.environ['AWS_ACCESS_KEY_ID']=config['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS_SECRET_ACCESS_KEY']
+os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
+os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
+
+""" 
+Create song_data schema as JSON structure to Spark 
+"""
+songdata_schema = StructType([
+    StructField("song_id", StringType(), True),
+    StructField("title", StringType(), True),
+    StructField("year", StringType(), True),
+    StructField("duration", DoubleType(), True),
+    StructField("artist_id", StringType(), True),
+    StructField("artist_name", StringType(), True),
+    StructField("artist_location", StringType(), True),
+    StructField("artist_latitude", DoubleType(), True),
+    StructField("artist_longitude", DoubleType(), True),
+    ])
+
+""" 
+Create log_data schema as JSON structure to Spark 
+"""
+logdata_schema = StructType([
+    StructField("artist", StringType(), True),
+    StructField("auth", StringType(), True),
+    StructField("firstName", StringType(), True),
+    StructField("gender", StringType(), True),
+    StructField("itemInSession", LongType(), True),
+    StructField("lastName", StringType(), True),
+    StructField("length", DoubleType(), True),
+    StructField("level", StringType(), True),
+    StructField("location", StringType(), True),
+    StructField("method", StringType(), True),
+    StructField("page", StringType(), True),
+    StructField("registration", DoubleType(), True),
+    StructField("sessionId", LongType(), True),
+    StructField("song", StringType(), True),
+    StructField("status", LongType(), True),
+    StructField("ts", LongType(), True),
+    StructField("userAgent", StringType(), True),
+    StructField("userId", StringType(), True),
+])
 
 
 def create_spark_session():
     spark = SparkSession \
         .builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.sql.session.timeZone", "UTC") \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
-    """ 
-        Song and artist data are processed from JSON files in S3.
-        These data will be normalized first then written as parquet files with suggested partition (by year and artist)
+def write_table(df, path, partition_by=(), mode=None, dynamic=False):
     """
-    """ 
-    Create song_data schema as JSON structure to Spark 
+        Writes df as parquet files of about TARGET_FILE_MB ([ETL] in dl.cfg). The rows of every partition are
+        counted and shuffled to as many files as their estimated size (ROW_BYTES per row) needs, so a partition
+        gets a few full files instead of a small file from every task that has some of its rows.
+        With dynamic, an overwrite only replaces the partitions df has rows for, otherwise it replaces the table
     """
-    songdata_schema = StructType([
-        StructField("song_id", StringType(), True),
-        StructField("year", StringType(), True),
-        StructField("duration", DoubleType(), True),
-        StructField("artist_id", StringType(), True),
-        StructField("artist_name", StringType(), True),
-        StructField("artist_location", StringType(), True),
-        StructField("artist_latitude", DoubleType(), True),
-        StructField("artist_longitude", DoubleType(), True),
-        ])
+    target_rows = max(1, config.getint('ETL', 'TARGET_FILE_MB') * 2 ** 20 // config.getint('ETL', 'ROW_BYTES'))
+    df = df.cache()
 
+    if partition_by:
+        # files of every partition, matched null-safe as a null partition value is a partition too
+        files = df.groupBy(*partition_by).count(). \
+            select(*[col(column).alias("_" + column) for column in partition_by],
+                   ceil(col("count") / target_rows).alias("_files"))
+        total_files = files.agg(spark_sum("_files")).first()[0] or 1
+        written = df.join(broadcast(files), [df[column].eqNullSafe(files["_" + column]) for column in partition_by]). \
+            withColumn("_file", pmod(spark_hash(*[df[column] for column in df.columns]), col("_files"))). \
+            repartition(total_files, *partition_by, "_file"). \
+            drop(*["_" + column for column in partition_by], "_files", "_file")
+    else:
+        written = df.repartition(max(1, -(-df.count() // target_rows)))
+
+    writer = written.write
+    if mode:
+        writer = writer.mode(mode)
+    if dynamic:
+        writer = writer.option("partitionOverwriteMode", "dynamic")
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(path)
+    df.unpersist()
+
+
+def read_song_data(spark, input_data):
+    """ 
+        Song data is read once from the JSON files in S3 with songdata_schema (no scan to infer the types)
+        and cached: the songs and artists tables and the songplays join all use this DataFrame,
+        so the files are listed and read a single time
+    """
     # get filepath to song data file
     song_data = input_data + "song-data/*/*/*/*.json"
 
-
     # read song data file from songdata_schema above (JSON structure)
-    df = spark.read.json(song_data, schema=songdata_schema).dropDuplicates()
+    return spark.read.json(song_data, schema=songdata_schema).dropDuplicates().cache()
 
+
+def process_song_data(spark, df, output_data):
+    """ 
+        Song and artist data are processed from the song DataFrame of read_song_data.
+        These data will be normalized first then written as parquet files with suggested partition (by year and artist)
+    """
     # extract columns to create songs table 
     """
         song table has 4 columns song_id, artist_id, year, duration
@@ -55,116 +125,192 @@ def process_song_data(spark, input_data, output_data):
     songs_table = df.select('song_id', 'artist_id', 'year', 'duration')
     
     # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy('year', 'artist_id').parquet(output_data + "songs")
+    write_table(songs_table, output_data + "songs", ['year', 'artist_id'], mode="overwrite")
 
     # extract columns to create artists table
     artists_table = df.select('artist_id', 'artist_name', 'artist_location', 'artist_latitude',
                               'artist_longitude') 
     
     # write artists table to parquet files
-    artists_table.write.parquet(output_data + "artists")
+    write_table(artists_table, output_data + "artists", mode="overwrite")
+
 
+def song_dimension(song_df):
+    """
+        Songs as a log event names them: one row per (title, artist_name, duration),
+        the song with the smallest song_id when several share the key
+    """
+    key = Window.partitionBy("title", "artist_name", "duration").orderBy("song_id")
+    return song_df.select("song_id", "artist_id", "title", "artist_name", "duration"). \
+        withColumn("n", row_number().over(key)). \
+        filter(col("n") == 1). \
+        drop("n")
+
+
+def join_songs(df, songs, broadcast_songs=True, salt_buckets=1):
+    """
+        Joins the NextSong events to the song dimension on (title, artist_name, duration).
+        The dimension is small, it is broadcast to every executor and the events are not shuffled.
+        Without broadcast, the events are salted over salt_buckets partitions per key and the songs copied
+        to every bucket, so the events of a hot song or artist do not all land in one task.
+    """
+    if broadcast_songs:
+        songs = broadcast(songs)
+        return df.join(songs, (df.song == songs.title) & (df.artist == songs.artist_name) & (df.length == songs.duration))
 
-def process_log_data(spark, input_data, output_data):
+    df = df.withColumn("salt", pmod(spark_hash("sessionId", "ts"), lit(salt_buckets)))
+    songs = songs.withColumn("salt", explode(array([lit(i) for i in range(salt_buckets)])))
+    return df.join(songs, (df.song == songs.title) & (df.artist == songs.artist_name) & (df.length == songs.duration)
+                   & (df.salt == songs.salt)). \
+        drop(df.salt).drop(songs.salt)
+
+
+def merge_users(spark, users_table, path):
+    """
+        Writes users_table over the users of the table at path, the other users are kept. Spark cannot overwrite
+        the files it reads, the merged table is written to path_staging then renamed to path, the previous
+        table is renamed to path_old until then (and renamed back by the next run if the rename failed)
+    """
+    Path = spark._jvm.org.apache.hadoop.fs.Path
+    fs = Path(path).getFileSystem(spark._jsc.hadoopConfiguration())
+    staging, old = path + "_staging", path + "_old"
+    if not fs.exists(Path(path)) and fs.exists(Path(old)):
+        fs.rename(Path(old), Path(path))
+
+    if fs.exists(Path(path)):
+        existing = spark.read.parquet(path)
+        users_table = existing.join(users_table, "user_id", "left_anti").unionByName(users_table)
+    write_table(users_table, staging, mode="overwrite")
+
+    if fs.exists(Path(path)):
+        fs.delete(Path(old), True)
+        fs.rename(Path(path), Path(old))
+    fs.rename(Path(staging), Path(path))
+    fs.delete(Path(old), True)
+
+
+def log_data_paths(spark, input_data, start, end):
+    """
+        The log-data files of the days from start to end, log-data/YYYY/MM/YYYY-MM-DD-events.json,
+        only the paths matching a file are kept as Spark fails on a path with no file
+    """
+    paths = []
+    for n in range((end - start).days + 1):
+        day = start + timedelta(days=n)
+        path = "{}log-data/{:%Y/%m}/{:%Y-%m-%d}-*.json".format(input_data, day, day)
+        hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+        if hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).globStatus(hadoop_path):
+            paths.append(path)
+    return paths
+
+
+def process_log_data(spark, input_data, output_data, song_df, start=None, end=None):
     """ 
         Log data is being processed from JSON files in S3. It contains user data, time table, songplay
         First data needs to be normalized, transformed then written as parquet files.
+        The songplays are joined to the song dimension of song_df, the song DataFrame of read_song_data,
+        see join_songs and [ETL] in dl.cfg.
+        With start and end only the log files of these days are read and only their year/month/day
+        partitions of time and songplays are overwritten (dynamic partition overwrite, a full run replaces
+        the whole tables, with the files of any earlier layout), users is not
+        partitioned, their users are merged into it (merge_users).
     """ 
-    """
-        JSON structure to Spark 
-    """
-    logdata_schema = StructType([
-        StructField("artist", StringType(), True),
-        StructField("auth", StringType(), True),
-        StructField("firstName", StringType(), True),
-        StructField("gender", StringType(), True),
-        StructField("itemInSession", LongType(), True),
-        StructField("lastName", StringType(), True),
-        StructField("length", DoubleType(), True),
-        StructField("level", StringType(), True),
-        StructField("location", StringType(), True),
-        StructField("method", StringType(), True),
-        StructField("page", StringType(), True),
-        StructField("registration", DoubleType(), True),
-        StructField("sessionId", LongType(), True),
-        StructField("song", StringType(), True),
-        StructField("status", LongType(), True),
-        StructField("ts", LongType(), True),
-        StructField("userAgent", StringType(), True),
-        StructField("userId", StringType(), True),
-    ])
 
     # get filepath to log data file
-    log_data = input_data + 'log-data'
+    if start is None:
+        log_data = input_data + 'log-data'
+    else:
+        log_data = log_data_paths(spark, input_data, start, end)
+        if not log_data:
+            print('No log data from {:%Y-%m-%d} to {:%Y-%m-%d}'.format(start, end))
+            return
 
     # read log data file, JSON structure
     df = spark.read.json(log_data, schema = logdata_schema).dropDuplicates()
+
+    if start is not None:
+        # only the events of the days, their partitions are replaced as a whole
+        epoch = datetime(1970, 1, 1)
+        df = df.filter((col("ts") >= int((start - epoch).total_seconds() * 1000)) &
+                       (col("ts") < int((end + timedelta(days=1) - epoch).total_seconds() * 1000)))
     
     # filter by actions for song plays
     df = df.filter(col("page") == 'NextSong')
+
+    # create timestamp column from original timestamp column, once for the time and songplays tables:
+    # ts is in milliseconds, the seconds since the epoch cast to a timestamp, no string formatting and parsing
+    df = df.withColumn("start_time", (col("ts") / 1000).cast(TimestampType()))
     
-    # extract columns for users table
-    users_table = df.select(col("userId").alias("user_id"),col("firstName").alias("first_name"),
-                            col("lastName").alias("last_name"),"gender","level")
+    # extract columns for users table, one row per user from their last event (the level can change)
+    last_event = Window.partitionBy("userId").orderBy(col("ts").desc())
+    users_table = df.withColumn("n", row_number().over(last_event)). \
+        filter(col("n") == 1). \
+        select(col("userId").alias("user_id"),col("firstName").alias("first_name"),
+               col("lastName").alias("last_name"),"gender","level")
     
     
-    # write users table to parquet files
-    users_table.write.parquet(output_data+"users")
+    # write users table to parquet files, a full run rewrites it
+    if start is None:
+        write_table(users_table, output_data+"users", mode="overwrite")
+    else:
+        merge_users(spark, users_table, output_data+"users")
 
-    # create timestamp column from original timestamp column
-    timestampFormat = "yyyy-MM-dd HH:MM:ss z"
-
-    get_timestamp = df.withColumn('ts',
-                               to_timestamp(date_format((df.ts 
-                                                         /1000).cast(dataType=TimestampType()), timestampFormat), timestampFormat))
-    
-    # create datetime column from original timestamp column
-    #get_datetime = udf()
-    #df =
-    # with get_timestamp, we can get the datetime column
-    
     # extract columns to create time table
-    time_table = get_timestamp.select(col("ts").alias("start_time"),
-                                   hour(col("ts")).alias("hour"),
-                                   dayofmonth(col("ts")).alias("day"), 
-                                   weekofyear(col("ts")).alias("week"), 
-                                   month(col("ts")).alias("month"),
-                                   year(col("ts")).alias("year"))
+    time_table = df.select("start_time",
+                           hour(col("start_time")).alias("hour"),
+                           dayofmonth(col("start_time")).alias("day"), 
+                           weekofyear(col("start_time")).alias("week"), 
+                           month(col("start_time")).alias("month"),
+                           year(col("start_time")).alias("year"))
     
-    # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy("year","month").parquet(output_data+"time")
+    # write time table to parquet files partitioned by year, month and day,
+    # a run for some days only overwrites their partitions, a full run the whole table
+    write_table(time_table, output_data+"time", ["year","month","day"], mode="overwrite", dynamic=start is not None)
 
 
-    # read in song data to use for songplays table
-    song_data = input_data+"song-data/*/*/*/*.json"
-    song_df = spark.read.json(song_data)
-
-    # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = song_df.join(df, song_df.artist_name==df.artist).
-    withColumn("songplay_id", monotonically_increasing_id()).
-    withColumn('start_time', to_timestamp(date_format((col("ts") /1000).cast(dataType=TimestampType()), timestampFormat),timestampFormat)).                             select("songplay_id",
+    # extract columns from joined song and log datasets to create songplays table,
+    # the songplay_id is a hash of the event so a rerun gives every songplay the same id
+    songplays = join_songs(df, song_dimension(song_df),
+                           config.getboolean('ETL', 'BROADCAST_SONGS'), config.getint('ETL', 'SALT_BUCKETS'))
+    songplays_table = songplays. \
+        withColumn("songplay_id", md5(concat_ws("|", col("userId"), col("sessionId"), col("ts")))). \
+        select("songplay_id",
            "start_time",                         
            col("userId").alias("user_id"),
            "level",
            "song_id",
            "artist_id",
            col("sessionId").alias("session_id"),
-           col("artist_location").alias("location"),
+           "location",
            "userAgent",
+           dayofmonth(col("start_time")).alias("day"),
            month(col("start_time")).alias("month"),
            year(col("start_time")).alias("year")) 
 
-    # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy("year","month").parquet(output_data+"songplays")
+    # write songplays table to parquet files partitioned by year, month and day,
+    # a run for some days only overwrites their partitions, a full run the whole table
+    write_table(songplays_table, output_data+"songplays", ["year","month","day"], mode="overwrite",
+                dynamic=start is not None)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Load the song and log data into the parquet tables of the data lake')
+    parser.add_argument('--date', type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                        help='only process the log data of this day (YYYY-MM-DD), the song tables are not rewritten')
+    parser.add_argument('--end', type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                        help='with --date, process the days from --date to this one')
+    args = parser.parse_args()
+
     spark = create_spark_session()
     input_data = "s3a://udacity-dend/"
     output_data = "s3a://udacity-dend/"
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    # the song data is read once for both stages
+    song_df = read_song_data(spark, input_data)
+    if args.date is None:
+        process_song_data(spark, song_df, output_data)    
+    process_log_data(spark, input_data, output_data, song_df, args.date, args.end or args.date)
+    song_df.unpersist()
 
 
 if __name__ == "__main__":